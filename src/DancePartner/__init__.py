@@ -1,8 +1,15 @@
+from .bert_cache import *
 from .bert_functions import *
+from .bert_onnx import *
+from .bert_server import *
+from .prefilter import *
 from .create_synonym_table import *
 from .deduplicate_papers import *
 from .extract_terms import *
 from .find_terms_in_papers import *
+from .term_matcher import *
+from .sentence_cache import *
+from .cooccurrence import *
 from .pull_ome import *
 from .pull_papers import *
 from .pull_relationships import *
@@ -0,0 +1,174 @@
+import os
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+# Files of a model folder that determine its predictions
+_MODEL_FILES = ("config.json", ".bin", ".safetensors")
+
+# Keys looked up per query. SQLite limits the number of parameters in a statement.
+_QUERY_SIZE = 500
+
+# Puts between exact counts of the predictions, which pick up predictions stored by other processes
+_RECOUNT_PUTS = 1000
+
+def model_fingerprint(model_path: str, *settings):
+    """
+    Hash the files that determine a model's predictions: the config and weight files of a model folder, or a single
+    model file such as an exported ONNX model. Settings that change the predictions (such as the tokenizer, or
+    quantization) are hashed with the files.
+
+    Parameters
+    ----------
+    model_path
+        A path to a model folder or model file
+
+    *settings
+        Any settings to include in the fingerprint
+
+    Returns
+    -------
+        The sha256 hex digest of the model
+    """
+
+    if os.path.isdir(model_path):
+        paths = [os.path.join(model_path, file) for file in sorted(os.listdir(model_path)) if file.endswith(_MODEL_FILES)]
+    else:
+        paths = [model_path]
+
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    for setting in settings:
+        digest.update(b"\0" + str(setting).encode("utf-8"))
+    return digest.hexdigest()
+
+class PredictionCache:
+    """
+    A persistent cache of model predictions in a SQLite file, keyed by a hash of the exact model input and a model
+    fingerprint (see `model_fingerprint`), so one cache may hold the predictions of several models and a retrained
+    model never reads stale predictions. When the cache holds more than max_entries predictions, the least recently
+    used are evicted. Several processes may share a cache file, and each counts the predictions exactly every 1,000
+    puts, so the file may briefly hold more than max_entries predictions. Close it with `close`, or use it in a
+    with statement.
+
+    Parameters
+    ----------
+    path
+        Path to the SQLite file. It is created if it does not exist.
+
+    max_entries
+        The most predictions to keep. Default is 10,000,000.
+    """
+    def __init__(self, path: str, max_entries: int = 10000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout = 60, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, probs BLOB NOT NULL, used INTEGER NOT NULL) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)")
+
+        # Counting every row is slow for a large cache, so keep a running count
+        self._entries = len(self)
+        self._puts = 0
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def keys(self, inputs: list[str], fingerprint: str):
+        """
+        Hash each model input with the model fingerprint.
+
+        Parameters
+        ----------
+        inputs
+            The exact text of each model input
+
+        fingerprint
+            The fingerprint of the model
+
+        Returns
+        -------
+            A list of keys
+        """
+        prefix = fingerprint.encode("utf-8") + b"\0"
+        return [hashlib.blake2b(prefix + x.encode("utf-8"), digest_size = 16).digest() for x in inputs]
+
+    def get(self, keys: list[bytes], num_labels: int = 2):
+        """
+        Look up predictions, marking the ones found as recently used.
+
+        Parameters
+        ----------
+        keys
+            Keys from `keys`
+
+        num_labels
+            The number of classes the model predicts. Default is 2.
+
+        Returns
+        -------
+            A numpy array of the probability of each class for each key. Keys that are not cached are NaN.
+        """
+        found = {}
+        distinct = list(dict.fromkeys(keys))
+        with self.connection:
+            for start in range(0, len(distinct), _QUERY_SIZE):
+                query = distinct[start:start + _QUERY_SIZE]
+                placeholders = ",".join("?" * len(query))
+                found.update(self.connection.execute("SELECT key, probs FROM predictions WHERE key IN (" + placeholders + ")", query).fetchall())
+                self.connection.execute("UPDATE predictions SET used = ? WHERE key IN (" + placeholders + ")", [time.time_ns()] + query)
+
+        probs = np.full((len(keys), num_labels), np.nan, dtype = np.float32)
+        for index, key in enumerate(keys):
+            if key in found:
+                probs[index] = np.frombuffer(found[key], dtype = np.float32)
+        return probs
+
+    def put(self, keys: list[bytes], probs: np.ndarray):
+        """
+        Store predictions, then evict the least recently used predictions if the cache is over max_entries.
+
+        Parameters
+        ----------
+        keys
+            Keys from `keys`
+
+        probs
+            A numpy array of the probability of each class for each key
+        """
+        used = time.time_ns()
+        probs = np.asarray(probs, dtype = np.float32)
+        distinct = list(dict.fromkeys(keys))
+        with self.connection:
+            # Keys that are already stored are replaced and do not add to the count
+            existing = 0
+            for start in range(0, len(distinct), _QUERY_SIZE):
+                query = distinct[start:start + _QUERY_SIZE]
+                existing += self.connection.execute("SELECT COUNT(*) FROM predictions WHERE key IN (" + ",".join("?" * len(query)) + ")", query).fetchone()[0]
+            self.connection.executemany("INSERT OR REPLACE INTO predictions (key, probs, used) VALUES (?, ?, ?)",
+                                        [(key, probs[index].tobytes(), used) for index, key in enumerate(keys)])
+
+            self._puts += 1
+            self._entries = len(self) if self._puts % _RECOUNT_PUTS == 0 else self._entries + len(distinct) - existing
+            excess = self._entries - self.max_entries
+            if excess > 0:
+                deleted = self.connection.execute("DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY used LIMIT ?)", (excess,))
+                self._entries -= deleted.rowcount
+
+    def close(self):
+        """
+        Close the connection to the SQLite file
+        """
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
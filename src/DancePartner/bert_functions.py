@@ -1,9 +1,12 @@
 import os 
+import io
+import sys
+import json
+import multiprocessing
 import pandas as pd
-from transformers import BertTokenizer, TrainingArguments, Trainer
+from transformers import BertTokenizer, TrainingArguments, Trainer, DataCollatorWithPadding
 from torch import nn
 import numpy as np
-import re
 
 from sklearn.preprocessing import LabelEncoder
 from transformers import BertTokenizer, TrainingArguments, Trainer
@@ -16,6 +19,25 @@ from transformers.modeling_outputs import SequenceClassifierOutput
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import accuracy_score, classification_report, precision_recall_fscore_support
 
+from .bert_cache import PredictionCache, model_fingerprint
+
+# Columns of find_terms_in_papers with the offsets of each term in the segment
+_OFFSET_COLUMNS = ["term_1_start", "term_1_end", "term_2_start", "term_2_end"]
+
+def __find_term_offsets(df: pd.DataFrame, segment_col_name: str):
+    """
+    Find the first occurrence of each term in its segment as plain text, for tables without term offsets.
+    Missing terms have offsets of -1.
+    """
+    offsets = []
+    for term1, term2, segment in zip(df["term_1"].astype(str), df["term_2"].astype(str), df[segment_col_name]):
+        row = []
+        for term in (term1, term2):
+            start = segment.find(term)
+            row.extend([start, start + len(term)] if start >= 0 else [-1, -1])
+        offsets.append(row)
+    return np.array(offsets, dtype = np.int64).reshape(-1, 4)
+
 def __make_bert_ready(df: pd.DataFrame, segment_col_name: str):
     """
     Function to prepare a dataframe to be inputted into the BERT model
@@ -36,19 +58,51 @@ def __make_bert_ready(df: pd.DataFrame, segment_col_name: str):
     # Add required columns to data frame. BERT cannot handle more than 250 characters 
     df['Term1'] = "@TERM$1"
     df['Term2'] = "@TERM$2"
-    df_clean = df[(df[segment_col_name].str.len() < 250) & (df[segment_col_name].str.len() > 0)] #Check that text is btwn 1 and 250 characters
-    
-    # Replace first occurences of protein terms with MASK variables
-    df_clean['Sentence'] = df_clean.apply(lambda row: re.sub(str(row["term_1"]), " @TERM$1 ", row[segment_col_name], count=1), axis=1)
-    df_clean['Sentence'] = df_clean.apply(lambda row: re.sub(str(row["term_2"]), " @TERM$2 ", row.Sentence, count=1), axis=1)
-    df_clean['Guess'] = 0
-    
-    # Check that '@TERM$1' and '@TERM$2' only appear once in each sentence segment
-    df_checked = df_clean[df_clean.Sentence.str.count("@TERM\$1") == 1]
-    df_checked = df_checked[df_checked.Sentence.str.count("@TERM\$2") == 1]
+    df_clean = df[(df[segment_col_name].str.len() < 250) & (df[segment_col_name].str.len() > 0)].copy() #Check that text is btwn 1 and 250 characters
+    segments = df_clean[segment_col_name].tolist()
+
+    # Use the offsets of the terms found by find_terms_in_papers, or otherwise find the first occurrence of each term
+    if all(column in df_clean.columns for column in _OFFSET_COLUMNS):
+        offsets = df_clean[_OFFSET_COLUMNS].fillna(-1).to_numpy(dtype = np.int64)
+    else:
+        offsets = __find_term_offsets(df_clean, segment_col_name)
+
+    # Replace the protein terms with MASK variables. Drop terms missing from the segment and terms that overlap.
+    sentences, keep = [], []
+    for segment, (start1, end1, start2, end2) in zip(segments, offsets.tolist()):
+        if min(start1, start2) < 0 or start1 >= end1 or start2 >= end2 or max(end1, end2) > len(segment) or (start1 < end2 and start2 < end1):
+            keep.append(False)
+            continue
+        if start1 < start2:
+            sentences.append(segment[:start1] + " @TERM$1 " + segment[end1:start2] + " @TERM$2 " + segment[end2:])
+        else:
+            sentences.append(segment[:start2] + " @TERM$2 " + segment[end2:start1] + " @TERM$1 " + segment[end1:])
+        keep.append(True)
+
+    df_checked = df_clean[np.array(keep, dtype = bool)].copy()
+    df_checked['Sentence'] = sentences
+    df_checked['Guess'] = 0
     df_checked = df_checked.drop(columns=[segment_col_name])
     return(df_checked)
 
+def _marked_sentences(table: pd.DataFrame, segment_col_name: str):
+    """
+    The "Sentence" that `__make_bert_ready` gives BERT for each row of a table, with the same index as the table.
+    Rows that BERT cannot score are NaN.
+    """
+    ready = __make_bert_ready(table.set_axis(range(len(table)), axis = 0), segment_col_name)
+    sentences = pd.Series(np.nan, index = range(len(table)), dtype = object)
+    sentences[ready.index] = ready["Sentence"]
+    return sentences.set_axis(table.index, axis = 0)
+
+def __masked_inputs(df: pd.DataFrame, x_col: str, e1_col: str, e2_col: str):
+    """
+    The two masked sentences of each row: one with the first entity masked and one with the second
+    """
+    x1 = [x.replace(e, "[MASK]") for x, e in zip(df[x_col], df[e1_col])]
+    x2 = [x.replace(e, "[MASK]") for x, e in zip(df[x_col], df[e2_col])]
+    return x1, x2
+
 def __preprocess_data(df: pd.DataFrame, tokenizer: BertTokenizer, x_col: str, y_col: str, e1_col: str, e2_col: str):
     """
     Function to preprocess data for BERT
@@ -75,16 +129,19 @@ def __preprocess_data(df: pd.DataFrame, tokenizer: BertTokenizer, x_col: str, y_
 
     Returns
     -------
-        A SrcDataset
+        A SrcDataset. Sequences are not padded, so batches must be padded when they are formed (see `DataCollatorWithPadding`).
     """
     # 2-Masted-senteces input format
-    x1 = df.apply(lambda x: x[x_col].replace(x[e1_col], "[MASK]"), axis=1).tolist()
-    x2 = df.apply(lambda x: x[x_col].replace(x[e2_col], "[MASK]"), axis=1).tolist()
+    x1, x2 = __masked_inputs(df, x_col, e1_col, e2_col)
 
     label_encoder = LabelEncoder()
     y = torch.tensor(label_encoder.fit_transform(df[y_col]), dtype=torch.long)
 
-    tokenized_x = tokenizer(x1, x2, return_tensors="pt", padding='max_length', truncation=True, max_length=512)
+    # Padding to 512 tokens would make most of each sequence padding, so pad each batch to its longest sequence instead
+    if len(x1) > 0:
+        tokenized_x = tokenizer(x1, x2, padding=False, truncation=True, max_length=512)
+    else:
+        tokenized_x = {"input_ids": [], "token_type_ids": [], "attention_mask": []}
 
     dataset = SrcDataset(tokenized_x, y)
     return dataset
@@ -105,6 +162,73 @@ class SrcDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.labels)
 
+    def lengths(self):
+        """
+        The number of tokens in each sequence
+        """
+        return [len(x) for x in self.encodings["input_ids"]]
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that sorts sequences by length and groups sequences of similar length into batches of at most
+    max_tokens tokens once padded, so short sequences are scored in large batches and long sequences in small ones.
+    Batches hold dataset indices, so results can be put back in the original order with `order`.
+
+    Parameters
+    ----------
+    lengths
+        The number of tokens in each sequence.
+
+    max_tokens
+        The maximum number of tokens in a padded batch (batch size times its longest sequence). A sequence longer
+        than max_tokens is a batch on its own. Default is 16384.
+
+    max_batch_size
+        An optional maximum number of sequences in a batch.
+    """
+    def __init__(self, lengths: list[int], max_tokens: int = 16384, max_batch_size: int = None):
+        self.batches = []
+        batch, longest = [], 0
+        for index in sorted(range(len(lengths)), key = lambda x: lengths[x]):
+            longest_with = max(longest, lengths[index])
+            if len(batch) > 0 and ((len(batch) + 1) * longest_with > max_tokens or len(batch) == max_batch_size):
+                self.batches.append(batch)
+                batch, longest_with = [], lengths[index]
+            batch.append(index)
+            longest = longest_with
+        if len(batch) > 0:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def order(self):
+        """
+        The dataset index of each sequence, in the order sequences are batched
+        """
+        return np.array([index for batch in self.batches for index in batch], dtype = np.int64)
+
+class _BucketedTrainer(Trainer):
+    """
+    Trainer that predicts with a custom batch sampler, such as a TokenBudgetBatchSampler
+    """
+    def __init__(self, batch_sampler: torch.utils.data.Sampler, **kwargs):
+        super().__init__(**kwargs)
+        self.batch_sampler = batch_sampler
+
+    def get_test_dataloader(self, test_dataset):
+        dataloader = torch.utils.data.DataLoader(
+            test_dataset,
+            batch_sampler = self.batch_sampler,
+            collate_fn = self.data_collator,
+            num_workers = self.args.dataloader_num_workers,
+            pin_memory = self.args.dataloader_pin_memory
+        )
+        return self.accelerator.prepare(dataloader)
+
 class BertSrcClassifier(BertPreTrainedModel):
     """
     Dataset class for BertSRC Classifier
@@ -204,7 +328,757 @@ class BertSrcClassifier(BertPreTrainedModel):
             attentions=outputs.attentions,
         )
 
-def run_bert(input_path: str, model_path: str, output_directory: str, segment_col_name: str, **kwargz):
+class BertSrcMultiPairClassifier(BertPreTrainedModel):
+    """
+    Classifier that scores every pair of entities in a sentence from one pass of the encoder. Each entity is
+    replaced by a [MASK] token, and a pair is scored from the hidden states of its two [MASK] tokens with the same
+    dense and classifier layers as `BertSrcClassifier`, so a fine-tuned BertSrcClassifier can be loaded into it
+    with `from_pretrained`. BertSrcClassifier is trained on a separate input for each pair, so its weights give
+    approximate scores in this head until it is fine-tuned with `fine_tune_multi_pair`.
+    """
+    def __init__(self, config, num_token_layer: int = 2, **kwargs):
+        super().__init__(config)
+        self.n_output_layer = num_token_layer
+        self.num_labels = config.num_labels
+        self.config = config
+
+        self.bert = BertModel(config)
+        self.dense = Linear(config.hidden_size * num_token_layer, config.hidden_size)
+        self.activation = Tanh()
+        self.dropout = Dropout(p = 0.5)
+        self.classifier = Linear(config.hidden_size, config.num_labels)
+
+        self.post_init()
+
+    def forward(
+        self,
+        input_ids: torch.Tensor = None,
+        attention_mask: torch.Tensor = None,
+        token_type_ids: torch.Tensor = None,
+        entity_positions: torch.Tensor = None,
+        pair_index: torch.Tensor = None,
+        labels: torch.Tensor = None,
+        return_dict: bool = None,
+    ):
+        """
+        entity_positions is an (entities, 2) tensor of the sequence in the batch and the token position of each
+        entity's [MASK] token, and pair_index is a (pairs, 2) tensor of the rows of entity_positions of each pair.
+        The logits have one row per pair.
+        """
+        return_dict = (
+            return_dict if return_dict is not None else self.config.use_return_dict
+        )
+
+        outputs = self.bert(input_ids, attention_mask = attention_mask, token_type_ids = token_type_ids, return_dict = True)
+        entities = outputs.last_hidden_state[entity_positions[:, 0], entity_positions[:, 1]]
+        output = torch.cat([entities[pair_index[:, 0]], entities[pair_index[:, 1]]], dim = -1)
+
+        output = self.dense(output)
+        output = self.activation(output)
+        output = self.dropout(output)
+        logits = self.classifier(output)
+
+        loss = None
+        if labels is not None:
+            loss = CrossEntropyLoss()(logits.view(-1, self.num_labels), labels.view(-1))
+        if not return_dict:
+            return ((loss, logits) if loss is not None else (logits,))
+
+        return SequenceClassifierOutput(loss = loss, logits = logits)
+
+# Engines run_bert can score segments with
+_ENGINES = ["trainer", "torch", "onnx", "multi_pair"]
+
+def _prepare_multi_pair_input(table: pd.DataFrame, segment_col_name: str, tokenizer: BertTokenizer):
+    """
+    Make a table BERT ready with `__make_bert_ready`, and group its rows by segment so each distinct segment is
+    tokenized once with every term replaced by a [MASK] token. Terms that overlap cannot both be masked, so rows
+    with overlapping terms are put in another copy of the segment.
+
+    Returns
+    -------
+        The BERT ready table, a dictionary of the encodings of each sequence, and for each sequence, the token
+        positions of its entities and (row, first entity, second entity) for each of its pairs, where rows are
+        positions in the BERT ready table
+    """
+    segments = table[segment_col_name].tolist()
+    if all(column in table.columns for column in _OFFSET_COLUMNS):
+        offsets = table[_OFFSET_COLUMNS].fillna(-1).to_numpy(dtype = np.int64)
+    else:
+        offsets = __find_term_offsets(table, segment_col_name)
+
+    # __make_bert_ready keeps the labels of the rows it keeps, so work by position
+    index = table.index
+    ready = __make_bert_ready(table.set_axis(range(len(table)), axis = 0), segment_col_name)
+    kept = ready.index.to_numpy()
+    ready.index = index[kept]
+
+    # Rows of each distinct segment
+    groups = {}
+    for row, position in enumerate(kept.tolist()):
+        groups.setdefault(segments[position], []).append(row)
+
+    texts, spans = [], []
+    for segment, rows in groups.items():
+        remaining = rows
+        while len(remaining) > 0:
+            # Add rows while their terms do not overlap the terms already masked in this copy
+            selected, assigned, left = set(), [], []
+            for row in remaining:
+                start1, end1, start2, end2 = offsets[kept[row]].tolist()
+                row_spans = [(start1, end1), (start2, end2)]
+                if all(span in selected or all(span[1] <= other[0] or other[1] <= span[0] for other in selected) for span in row_spans):
+                    selected.update(row_spans)
+                    assigned.append((row, row_spans))
+                else:
+                    left.append(row)
+            remaining = left
+
+            # Replace every selected term with a [MASK] token
+            ordered = sorted(selected)
+            pieces, previous = [], 0
+            for start, end in ordered:
+                pieces.extend([segment[previous:start], " [MASK] "])
+                previous = end
+            pieces.append(segment[previous:])
+            texts.append("".join(pieces))
+            entity = {span: number for number, span in enumerate(ordered)}
+            spans.append([(row, entity[row_spans[0]], entity[row_spans[1]]) for row, row_spans in assigned])
+
+    if len(texts) > 0:
+        encodings = tokenizer(texts, padding = False, truncation = True, max_length = 512)
+    else:
+        encodings = {"input_ids": [], "token_type_ids": [], "attention_mask": []}
+
+    # Token positions of the [MASK] tokens. Pairs with a term cut off by truncation are not scored.
+    entities, pairs, scored = [], [], np.zeros(len(ready), dtype = bool)
+    for input_ids, sequence_pairs in zip(encodings["input_ids"], spans):
+        positions = np.flatnonzero(np.array(input_ids) == tokenizer.mask_token_id).tolist()
+        sequence_pairs = [pair for pair in sequence_pairs if max(pair[1], pair[2]) < len(positions)]
+        scored[[row for row, _, _ in sequence_pairs]] = True
+        entities.append(positions)
+        pairs.append(sequence_pairs)
+
+    return ready, encodings, entities, pairs, scored
+
+def _multi_pair_batch(batch: list[int], encodings: dict, entities: list, pairs: list, collator: DataCollatorWithPadding,
+                      device: torch.device):
+    """
+    The inputs of a BertSrcMultiPairClassifier for a batch of sequences from `_prepare_multi_pair_input`, and the
+    row of each of its pairs
+    """
+    features = collator([{key: encodings[key][sequence] for key in encodings.keys()} for sequence in batch])
+    entity_positions, pair_index, rows = [], [], []
+    for number, sequence in enumerate(batch):
+        first = len(entity_positions)
+        entity_positions.extend([number, position] for position in entities[sequence])
+        for row, entity1, entity2 in pairs[sequence]:
+            pair_index.append([first + entity1, first + entity2])
+            rows.append(row)
+    inputs = {key: value.to(device, non_blocking = True) for key, value in features.items()}
+    inputs["entity_positions"] = torch.tensor(entity_positions, dtype = torch.long, device = device).reshape(-1, 2)
+    inputs["pair_index"] = torch.tensor(pair_index, dtype = torch.long, device = device).reshape(-1, 2)
+    return inputs, rows
+
+def _predict_multi_pair(model: BertSrcMultiPairClassifier, encodings: dict, entities: list, pairs: list, n_rows: int,
+                        collator: DataCollatorWithPadding, device: torch.device, max_tokens: int = 16384, batch_size: int = None):
+    """
+    Score the pairs from `_prepare_multi_pair_input` in length-bucketed batches of sequences.
+
+    Returns
+    -------
+        A numpy array of the probability of each class for each row
+    """
+    lengths = [len(x) for x in encodings["input_ids"]]
+    probs = np.zeros((n_rows, model.num_labels), dtype = np.float32)
+    with torch.inference_mode():
+        for batch in TokenBudgetBatchSampler(lengths, max_tokens = max_tokens, max_batch_size = batch_size):
+            inputs, rows = _multi_pair_batch(batch, encodings, entities, pairs, collator, device)
+            if len(rows) == 0:
+                continue
+            logits = model(**inputs, return_dict = True).logits
+            probs[rows] = nn.functional.softmax(logits.float(), dim = -1).cpu().numpy()
+    return probs
+
+def _score_table(table: pd.DataFrame, segment_col_name: str, tokenizer: BertTokenizer, score_dataset,
+                 cache: PredictionCache = None, fingerprint: str = None):
+    """
+    Make a table BERT ready with `__make_bert_ready`, tokenize it, and score it with score_dataset, a function from a
+    SrcDataset to the probability of each class of each row. With a PredictionCache, cached inputs are looked up
+    before tokenizing, and only the distinct inputs that are not cached are scored.
+
+    Returns
+    -------
+        The BERT ready table, and a numpy array of the probabilities of its rows
+    """
+    table = __make_bert_ready(table, segment_col_name)
+    if cache is None:
+        return table, score_dataset(__preprocess_data(table, tokenizer, x_col = "Sentence", y_col = "Guess", e1_col = "Term1", e2_col = "Term2"))
+
+    x1, x2 = __masked_inputs(table, "Sentence", "Term1", "Term2")
+    keys = cache.keys([a + "\0" + b for a, b in zip(x1, x2)], fingerprint)
+    probs = cache.get(keys)
+
+    # The first row of each distinct input that is not cached
+    missing = {}
+    for row in np.flatnonzero(np.isnan(probs).any(axis = 1)).tolist():
+        missing.setdefault(keys[row], row)
+
+    if len(missing) > 0:
+        rows = list(missing.values())
+        scored = score_dataset(__preprocess_data(table.iloc[rows], tokenizer, x_col = "Sentence", y_col = "Guess", e1_col = "Term1", e2_col = "Term2"))
+        cache.put(list(missing), scored)
+        found = dict(zip(missing, scored))
+        for row, key in enumerate(keys):
+            if key in found:
+                probs[row] = found[key]
+    return table, probs
+
+def _predict_dataset(model: BertSrcClassifier, dataset: SrcDataset, collator: DataCollatorWithPadding, device: torch.device,
+                     max_tokens: int = 16384, batch_size: int = None, num_workers: int = 0, prefetch_factor: int = None):
+    """
+    Score a SrcDataset without a Trainer, in length-bucketed batches under `torch.inference_mode`.
+
+    Returns
+    -------
+        A numpy array of the probability of each class for each row of the dataset
+    """
+    batch_sampler = TokenBudgetBatchSampler(dataset.lengths(), max_tokens = max_tokens, max_batch_size = batch_size)
+    dataloader = torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler = batch_sampler,
+        collate_fn = collator,
+        num_workers = num_workers,
+        prefetch_factor = prefetch_factor if num_workers > 0 else None,
+        pin_memory = device.type == "cuda"
+    )
+
+    batch_probs = []
+    with torch.inference_mode():
+        for batch in dataloader:
+            batch.pop("labels", None)
+            logits = model(**{key: value.to(device, non_blocking = True) for key, value in batch.items()}, return_dict = True).logits
+            batch_probs.append(nn.functional.softmax(logits.float(), dim = -1).cpu().numpy())
+
+    # Put predictions back in the order of the rows
+    probs = np.zeros((len(dataset), model.num_labels), dtype = np.float32)
+    if len(batch_probs) > 0:
+        probs[batch_sampler.order()] = np.concatenate(batch_probs)
+    return probs
+
+class BertPredictor:
+    """
+    Scores tables of sentence segments with a BertSrcClassifier without a Trainer. The tokenizer and model are loaded
+    once, so a predictor can be kept and reused for many small tables with little overhead per call.
+
+    Parameters
+    ----------
+    model_path
+        A path to the folder containing the BERT model. See `run_bert`.
+
+    device
+        The torch device to run the model on, such as "cpu" or "cuda". Default is None, which uses a GPU if one is available
+        and the model is not quantized.
+
+    num_threads
+        The number of threads torch uses within operations on the CPU. This is set for the whole process. Default is
+        None, which keeps torch's default.
+
+    tokenizer_name
+        The name or path of the tokenizer. Default is "dmis-lab/biobert-base-cased-v1.2".
+
+    quantize
+        If True, quantize the weights of every Linear layer (the encoder and the dense and classifier head) to int8
+        with dynamic quantization, which uses about a quarter of the memory and runs faster on CPU at a small cost in
+        accuracy. Only supported on CPU. Check the agreement with the full model with `quantization_agreement`.
+        Default is False.
+
+    cache
+        An optional PredictionCache. Inputs this model has scored before are read from the cache instead of scored.
+
+    model_class
+        The class of the model to load. Default is BertSrcClassifier. Predictors that do not score with a torch model
+        in this process pass None, and their model is None.
+    """
+    def __init__(self, model_path: str, device: str = None, num_threads: int = None,
+                 tokenizer_name: str = "dmis-lab/biobert-base-cased-v1.2", quantize: bool = False, cache: PredictionCache = None,
+                 model_class: type = BertSrcClassifier):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() and quantize == False and model_class is not None else "cpu"
+        self.device = torch.device(device)
+        if quantize and self.device.type != "cpu":
+            raise Exception("Quantized models can only be run on the cpu device")
+        self.tokenizer = BertTokenizer.from_pretrained(tokenizer_name)
+        self.model = None
+        if model_class is not None:
+            self.model = model_class.from_pretrained(model_path, num_labels = 2, mask_token_id = self.tokenizer.mask_token_id)
+            self.model.to(self.device)
+            self.model.eval()
+            if quantize:
+                self.model = _quantize_model(self.model)
+        self.collator = DataCollatorWithPadding(self.tokenizer)
+        self.cache = cache
+        self.fingerprint = model_fingerprint(model_path, tokenizer_name, *(["int8"] if quantize else [])) if cache is not None else None
+
+    def _score_dataset(self, dataset: SrcDataset, max_tokens: int, batch_size: int, num_workers: int, prefetch_factor: int):
+        return _predict_dataset(self.model, dataset, self.collator, self.device, max_tokens, batch_size, num_workers, prefetch_factor)
+
+    def _score(self, table: pd.DataFrame, segment_col_name: str, max_tokens: int, batch_size: int, num_workers: int,
+               prefetch_factor: int):
+        score_dataset = lambda dataset: self._score_dataset(dataset, max_tokens, batch_size, num_workers, prefetch_factor)
+        return _score_table(table.copy(), segment_col_name, self.tokenizer, score_dataset, self.cache, self.fingerprint)
+
+    def predict_proba(self, table: pd.DataFrame, segment_col_name: str = "segment", max_tokens: int = 16384,
+                      batch_size: int = None, num_workers: int = 0, prefetch_factor: int = None):
+        """
+        Score every row of a table from `find_terms_in_papers`.
+
+        Parameters
+        ----------
+        table
+            A table of sentence segments with term_1 and term_2 columns.
+
+        segment_col_name
+            The name of the column representing the chunk of text containing the pair of biomolecules. Default is "segment".
+
+        max_tokens
+            The maximum number of tokens in a padded batch. See `TokenBudgetBatchSampler`. Default is 16384.
+
+        batch_size
+            An optional maximum number of segments in a batch.
+
+        num_workers
+            The number of DataLoader worker processes that form batches ahead of the model. Default is 0.
+
+        prefetch_factor
+            The number of batches each worker prepares in advance. Only used if num_workers is above 0.
+
+        Returns
+        -------
+            A numpy array with the "True Negative" and "True Positive" probabilities of each row. Rows that cannot be
+            scored (see `run_bert`) are NaN.
+        """
+        table = table.reset_index(drop = True)
+        scored, probs = self._score(table, segment_col_name, max_tokens, batch_size, num_workers, prefetch_factor)
+        all_probs = np.full((len(table), probs.shape[1]), np.nan, dtype = np.float32)
+        all_probs[scored.index.to_numpy()] = probs
+        return all_probs
+
+    def predict(self, table: pd.DataFrame, segment_col_name: str = "segment", max_tokens: int = 16384,
+                batch_size: int = None, num_workers: int = 0, prefetch_factor: int = None):
+        """
+        Score a table from `find_terms_in_papers`. The parameters are the same as `predict_proba`.
+
+        Returns
+        -------
+            The scored rows with "True Negative" and "True Positive" columns, as written by `run_bert`
+        """
+        scored, probs = self._score(table, segment_col_name, max_tokens, batch_size, num_workers, prefetch_factor)
+        scored[["True Negative", "True Positive"]] = probs
+        return scored.drop("Guess", axis = 1)
+
+class MultiPairBertPredictor(BertPredictor):
+    """
+    Scores tables with a BertSrcMultiPairClassifier, which encodes each distinct segment once and scores all of its
+    pairs from that one pass, instead of encoding the segment again for every pair. Sentences that mention many
+    terms are scored many times faster. The model should be fine-tuned in this head with `fine_tune_multi_pair`.
+    A BertSrcClassifier was trained on a separate input for each pair, so it only gives approximate scores in this
+    head, and it is refused unless approximate is True. Takes the same tables and returns the same results as
+    `BertPredictor`.
+
+    Parameters
+    ----------
+    model_path
+        A path to the folder containing the BERT model. See `run_bert`.
+
+    device
+        The torch device to run the model on. See `BertPredictor`.
+
+    num_threads
+        The number of threads torch uses within operations on the CPU. See `BertPredictor`.
+
+    tokenizer_name
+        The name or path of the tokenizer. Default is "dmis-lab/biobert-base-cased-v1.2".
+
+    quantize
+        If True, quantize the Linear layers to int8. See `BertPredictor`. Default is False.
+
+    approximate
+        If True, accept a model that was not fine-tuned with `fine_tune_multi_pair`, such as the BertSrcClassifier
+        used by `run_bert`, and score with approximate scores. Default is False.
+    """
+    def __init__(self, model_path: str, device: str = None, num_threads: int = None,
+                 tokenizer_name: str = "dmis-lab/biobert-base-cased-v1.2", quantize: bool = False, approximate: bool = False):
+        config = BertSrcMultiPairClassifier.config_class.from_pretrained(model_path)
+        if approximate == False and BertSrcMultiPairClassifier.__name__ not in (config.architectures or []):
+            raise Exception(model_path + " was not fine-tuned for the multi_pair engine, so its scores would be approximate. " +
+                            "Fine-tune it with fine_tune_multi_pair, or pass approximate = True to accept approximate scores.")
+        super().__init__(model_path, device, num_threads, tokenizer_name, quantize, model_class = BertSrcMultiPairClassifier)
+
+    def _score(self, table: pd.DataFrame, segment_col_name: str, max_tokens: int, batch_size: int, num_workers: int,
+               prefetch_factor: int):
+        # Batches are formed in this process, so num_workers and prefetch_factor are not used
+        table, encodings, entities, pairs, scored = _prepare_multi_pair_input(table.copy(), segment_col_name, self.tokenizer)
+        probs = _predict_multi_pair(self.model, encodings, entities, pairs, len(table), self.collator, self.device, max_tokens, batch_size)
+        return table[scored], probs[scored]
+
+def fine_tune_multi_pair(table: pd.DataFrame, model_path: str, output_path: str, label_col_name: str,
+                         segment_col_name: str = "segment", epochs: int = 3, learning_rate: float = 2e-5, max_tokens: int = 16384,
+                         device: str = None, tokenizer_name: str = "dmis-lab/biobert-base-cased-v1.2", random_state: int = 0):
+    """
+    Fine-tune a BertSrcClassifier (or a BertSrcMultiPairClassifier) in the multi-pair head, so the "multi_pair" engine
+    of `run_bert` scores with inputs the model was trained on. Labels may be annotated relationships, or the calls
+    of the pairwise model on a sample of pairs (from `BertPredictor.predict_proba`) to teach the multi-pair head to
+    agree with it.
+
+    Parameters
+    ----------
+    table
+        A table of sentence segments with term_1 and term_2 columns, such as a sample of `find_terms_in_papers`
+        results, and a label column
+
+    model_path
+        A path to the folder containing the BERT model to start from. See `run_bert`.
+
+    output_path
+        The folder to save the fine-tuned model to. Pass it as the model_path of `run_bert(engine = "multi_pair")`.
+
+    label_col_name
+        The name of the column that is True (or 1) for relationships
+
+    segment_col_name
+        The name of the column representing the chunk of text containing the pair of biomolecules. Default is "segment".
+
+    epochs
+        The number of passes over the table. Default is 3.
+
+    learning_rate
+        The learning rate of the AdamW optimizer. Default is 2e-5.
+
+    max_tokens
+        The maximum number of tokens in a padded batch. See `TokenBudgetBatchSampler`. Default is 16384.
+
+    device
+        The torch device to train on. Default is None, which uses a GPU if one is available.
+
+    tokenizer_name
+        The name or path of the tokenizer. Default is "dmis-lab/biobert-base-cased-v1.2".
+
+    random_state
+        The seed of the order of the batches. Default is 0.
+
+    Returns
+    -------
+        Saves the model to output_path, and returns the mean loss of each epoch
+    """
+
+    device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    tokenizer = BertTokenizer.from_pretrained(tokenizer_name)
+    model = BertSrcMultiPairClassifier.from_pretrained(model_path, num_labels = 2)
+    model.to(device)
+    collator = DataCollatorWithPadding(tokenizer)
+
+    ready, encodings, entities, pairs, scored = _prepare_multi_pair_input(table.copy(), segment_col_name, tokenizer)
+    labels = torch.tensor(ready[label_col_name].to_numpy(dtype = np.int64), device = device)
+    batches = list(TokenBudgetBatchSampler([len(x) for x in encodings["input_ids"]], max_tokens = max_tokens))
+    optimizer = torch.optim.AdamW(model.parameters(), lr = learning_rate)
+    generator = np.random.default_rng(random_state)
+
+    model.train()
+    epoch_losses = []
+    for epoch in range(epochs):
+        losses = []
+        for number in generator.permutation(len(batches)).tolist():
+            inputs, rows = _multi_pair_batch(batches[number], encodings, entities, pairs, collator, device)
+            if len(rows) == 0:
+                continue
+            loss = model(**inputs, labels = labels[rows], return_dict = True).loss
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        epoch_losses.append(float(np.mean(losses)) if len(losses) > 0 else np.nan)
+
+    model.eval()
+    model.save_pretrained(output_path)
+    return epoch_losses
+
+# The predictor of each worker process of a ShardedBertPredictor, or the error raised while loading it
+_worker_predictor = None
+_worker_error = None
+
+def _load_worker_predictor(model_path: str, engine: str, num_threads: int, quantize: bool, tokenizer_name: str):
+    """
+    Pool initializer that loads a copy of the model in each worker process, with a fixed number of threads. An
+    initializer that raises kills its worker and the pool starts another forever, so the error is kept and raised
+    when the worker is given a batch instead.
+    """
+    global _worker_predictor, _worker_error
+    try:
+        _worker_predictor = _load_predictor(model_path, engine, "cpu", num_threads, quantize, tokenizer_name = tokenizer_name)
+    except Exception as e:
+        _worker_error = "A worker could not load the model: " + repr(e)
+
+def _score_batch_in_worker(encodings: dict):
+    """
+    Score one batch of tokenized sequences inside a pool worker.
+    """
+    if _worker_error is not None:
+        raise Exception(_worker_error)
+    dataset = SrcDataset(encodings, torch.zeros(len(encodings["input_ids"]), dtype = torch.long))
+    return _worker_predictor._score_dataset(dataset, sys.maxsize, None, 0, None)
+
+class ShardedBertPredictor(BertPredictor):
+    """
+    Scores tables on CPU with several worker processes, each with its own copy of the model and a fixed number of
+    threads. On machines with many cores this scores more pairs per second than one process using every core.
+    Segments are tokenized and batched by length in this process, workers take batches as they finish their last
+    one, and probabilities are put back in the order of the rows. Takes the same tables and returns the same
+    results as `BertPredictor`. Call `close` (or use it in a with statement) to stop the workers. Workers are
+    started with spawn, so scripts must be run under `if __name__ == "__main__":`.
+
+    Parameters
+    ----------
+    model_path
+        A path to the folder containing the BERT model, or for the "onnx" engine, the exported ONNX model. See `run_bert`.
+
+    n_processes
+        The number of worker processes. Default is 2.
+
+    num_threads
+        The number of threads of each worker. Default is None, which divides the cores evenly between the workers.
+
+    engine
+        "torch" to score with a `BertPredictor` or "onnx" to score with an `OnnxBertPredictor` in each worker.
+        Default is "torch".
+
+    quantize
+        If True, each worker scores with an int8 quantized model. Only used by the "torch" engine. See `BertPredictor`.
+
+    tokenizer_name
+        The name or path of the tokenizer. Default is "dmis-lab/biobert-base-cased-v1.2".
+
+    cache
+        An optional PredictionCache. See `BertPredictor`.
+    """
+    def __init__(self, model_path: str, n_processes: int = 2, num_threads: int = None, engine: str = "torch", quantize: bool = False,
+                 tokenizer_name: str = "dmis-lab/biobert-base-cased-v1.2", cache: PredictionCache = None):
+        if engine not in _SHARDED_ENGINES:
+            raise Exception("engine must be one of: " + ", ".join(_SHARDED_ENGINES))
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // n_processes)
+
+        # Check the model can be found here, since errors in the workers only show once a batch is scored
+        if engine == "onnx":
+            try:
+                import onnxruntime
+            except:
+                raise Exception("To use the onnx engine, install onnxruntime.")
+            from .bert_onnx import _resolve_onnx_path
+            model_path = _resolve_onnx_path(model_path)
+        elif os.path.exists(os.path.join(model_path, "config.json")) == False or any(file.endswith((".bin", ".safetensors")) for file in os.listdir(model_path)) == False:
+            raise Exception(model_path + " is not a folder with a BERT model's config.json and weights. See run_bert.")
+
+        # The models are loaded in the workers
+        super().__init__(model_path, device = "cpu", tokenizer_name = tokenizer_name, quantize = quantize, cache = cache, model_class = None)
+
+        # Workers are spawned rather than forked, since the threads of the parent's math libraries do not survive a fork
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(n_processes, initializer = _load_worker_predictor,
+                                 initargs = (model_path, engine, num_threads, quantize, tokenizer_name))
+
+    def _score_dataset(self, dataset: SrcDataset, max_tokens: int, batch_size: int, num_workers: int, prefetch_factor: int):
+        batch_sampler = TokenBudgetBatchSampler(dataset.lengths(), max_tokens = max_tokens, max_batch_size = batch_size)
+        tasks = ({key: [dataset.encodings[key][index] for index in batch] for key in dataset.encodings.keys()} for batch in batch_sampler)
+
+        # imap returns batches in the order they were sent
+        probs = np.zeros((len(dataset), 2), dtype = np.float32)
+        if len(batch_sampler) > 0:
+            probs[batch_sampler.order()] = np.concatenate(list(self.pool.imap(_score_batch_in_worker, tasks)))
+        return probs
+
+    def close(self):
+        """
+        Stop the worker processes
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _quantize_model(model: BertSrcClassifier):
+    """
+    Quantize the weights of every Linear layer of a model to int8. Activations are quantized on the fly.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {Linear}, dtype = torch.qint8)
+
+def __model_megabytes(model: nn.Module):
+    """
+    The size of a model's saved weights in megabytes
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
+
+def quantization_agreement(table: pd.DataFrame, model_path: str, segment_col_name: str = "segment", threshold: float = 0.5,
+                           num_threads: int = None, max_tokens: int = 16384):
+    """
+    Score a held-out table of pairs with the full (fp32) model and the int8 quantized model, and report how often they agree.
+
+    Parameters
+    ----------
+    table
+        A table of sentence segments with term_1 and term_2 columns, such as a sample of `find_terms_in_papers` results.
+
+    model_path
+        A path to the folder containing the BERT model. See `run_bert`.
+
+    segment_col_name
+        The name of the column representing the chunk of text containing the pair of biomolecules. Default is "segment".
+
+    threshold
+        Pairs with a "True Positive" probability at or above this are called relationships. Default is 0.5.
+
+    num_threads
+        The number of CPU threads. See `BertPredictor`.
+
+    max_tokens
+        The maximum number of tokens in a padded batch. See `TokenBudgetBatchSampler`. Default is 16384.
+
+    Returns
+    -------
+        A dictionary with the number of "pairs" scored, the fraction of pairs with the same call ("agreement"), the
+        number of relationships called by each model ("positive_fp32" and "positive_int8"), the largest and mean
+        absolute difference in "True Positive" probability, and the size of each model's weights in megabytes.
+    """
+
+    predictor = BertPredictor(model_path, device = "cpu", num_threads = num_threads)
+    fp32 = predictor.predict_proba(table, segment_col_name, max_tokens)[:, 1]
+    fp32_megabytes = __model_megabytes(predictor.model)
+
+    # Quantizing the loaded model replaces its Linear layers, so score with the full model first
+    predictor.model = _quantize_model(predictor.model)
+    int8 = predictor.predict_proba(table, segment_col_name, max_tokens)[:, 1]
+
+    scored = np.isnan(fp32) == False
+    fp32, int8 = fp32[scored], int8[scored]
+    difference = np.abs(fp32 - int8)
+    return {
+        "pairs": int(scored.sum()),
+        "agreement": float(np.mean((fp32 >= threshold) == (int8 >= threshold))) if scored.any() else np.nan,
+        "positive_fp32": int((fp32 >= threshold).sum()),
+        "positive_int8": int((int8 >= threshold).sum()),
+        "max_difference": float(difference.max()) if scored.any() else np.nan,
+        "mean_difference": float(difference.mean()) if scored.any() else np.nan,
+        "fp32_megabytes": fp32_megabytes,
+        "int8_megabytes": __model_megabytes(predictor.model)
+    }
+
+def _predict_with_trainer(trainer: Trainer, tokenizer: BertTokenizer, table: pd.DataFrame, segment_col_name: str, max_tokens: int,
+                          cache: PredictionCache = None, fingerprint: str = None, max_batch_size: int = None):
+    """
+    Score a table of term pairs with a `_BucketedTrainer`, returning the results in the order of the rows. Batches
+    hold at most max_batch_size segments, if given.
+    """
+    def score_dataset(test_dataset):
+        # Batch segments of similar length together, padding each batch only to its longest segment
+        batch_sampler = TokenBudgetBatchSampler(test_dataset.lengths(), max_tokens = max_tokens, max_batch_size = max_batch_size)
+
+        # Put predictions back in the order of the rows
+        probs = np.zeros((len(test_dataset), 2), dtype = np.float32)
+        if len(test_dataset) > 0:
+            trainer.batch_sampler = batch_sampler
+            trainer_out = trainer.predict(test_dataset)
+            probs[batch_sampler.order()] = nn.functional.softmax(torch.from_numpy(trainer_out.predictions), dim = -1).numpy()
+        return probs
+
+    test, probs = _score_table(table, segment_col_name, tokenizer, score_dataset, cache, fingerprint)
+    test[["True Negative", "True Positive"]] = probs
+    return test.drop("Guess", axis = 1)
+
+# Engines that score with a BertPredictor
+_PREDICTOR_ENGINES = ["torch", "onnx", "multi_pair"]
+
+# Engines that can score with several worker processes
+_SHARDED_ENGINES = ["torch", "onnx"]
+
+def _load_predictor(model_path: str, engine: str = "torch", device: str = None, num_threads: int = None, quantize: bool = False,
+                    cache: PredictionCache = None, n_processes: int = 1, tokenizer_name: str = "dmis-lab/biobert-base-cased-v1.2",
+                    approximate: bool = False):
+    """
+    Load a BertPredictor for the "torch" engine, an OnnxBertPredictor for the "onnx" engine, or a
+    MultiPairBertPredictor for the "multi_pair" engine, or a ShardedBertPredictor with more than one process
+    """
+    if n_processes > 1:
+        if device is not None and device != "cpu":
+            raise Exception("More than one process is only supported on the cpu device")
+        return ShardedBertPredictor(model_path, n_processes, num_threads, engine, quantize, tokenizer_name, cache)
+    if engine == "onnx":
+        from .bert_onnx import OnnxBertPredictor
+        return OnnxBertPredictor(model_path, num_threads = num_threads, tokenizer_name = tokenizer_name, cache = cache)
+    if engine == "multi_pair":
+        if cache is not None:
+            raise Exception("A prediction cache is not supported by the multi_pair engine")
+        return MultiPairBertPredictor(model_path, device = device, num_threads = num_threads, tokenizer_name = tokenizer_name, quantize = quantize,
+                                      approximate = approximate)
+    return BertPredictor(model_path, device = device, num_threads = num_threads, tokenizer_name = tokenizer_name, quantize = quantize, cache = cache)
+
+def __write_bert_results(score, input_path: str, model_path: str, output_directory: str, segment_col_name: str, chunk_size: int,
+                         settings: dict = None):
+    """
+    Score the input with score, a function from a table to its results, and write "bert_results.txt". With a
+    chunk_size, the input is scored in chunks and a checkpoint is kept so a restarted run skips finished chunks.
+    The checkpoint records the input, the model path, the chunks, and the settings, which should hold everything else
+    that changes the results.
+    """
+    output_path = os.path.join(output_directory, "bert_results.txt")
+
+    if chunk_size is None:
+        score(pd.read_csv(input_path)).to_csv(output_path, sep = '\t', index = False, header = True)
+        return
+
+    # A checkpoint only applies to the same input, model, and chunks
+    checkpoint_path = os.path.join(output_directory, "bert_results_checkpoint.json")
+    input_stat = os.stat(input_path)
+    job = {"input_path": os.path.abspath(input_path), "input_size": input_stat.st_size, "input_mtime": input_stat.st_mtime_ns,
+           "model_path": os.path.abspath(model_path), "segment_col_name": segment_col_name, "chunk_size": chunk_size}
+    if settings is not None:
+        job.update(settings)
+
+    completed_chunks, output_size = 0, 0
+    if os.path.exists(checkpoint_path) and os.path.exists(output_path):
+        with open(checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("job") == job:
+            completed_chunks, output_size = checkpoint["completed_chunks"], checkpoint["output_size"]
+
+    # Drop any results written after the last checkpoint, such as a chunk that was interrupted mid-write
+    with open(output_path, "a") as f:
+        f.truncate(output_size)
+
+    # Skip the rows of finished chunks without building tables from them. Rows are skipped as records, so quoted
+    # newlines within a segment are handled.
+    chunks = pd.read_csv(input_path, chunksize = chunk_size, skiprows = range(1, completed_chunks * chunk_size + 1))
+    for index, chunk in enumerate(chunks, start = completed_chunks):
+        score(chunk).to_csv(output_path, mode = "a", sep = '\t', index = False, header = (index == 0))
+
+        # Write to a temporary file first so an interrupted run never leaves a partial checkpoint
+        temp_path = checkpoint_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"job": job, "completed_chunks": index + 1, "output_size": os.path.getsize(output_path)}, f)
+        os.replace(temp_path, checkpoint_path)
+
+def run_bert(input_path: str, model_path: str, output_directory: str, segment_col_name: str, max_tokens: int = 16384,
+             engine: str = "trainer", device: str = None, num_threads: int = None, batch_size: int = None,
+             num_workers: int = 0, prefetch_factor: int = None, chunk_size: int = None, quantize: bool = False,
+             cache_path: str = None, n_processes: int = 1, prefilter = None, prefilter_threshold: float = None,
+             approximate: bool = False, **kwargz):
     """
     Function to prepare a dataframe to be inputted into the BERT model
 
@@ -222,48 +1096,146 @@ def run_bert(input_path: str, model_path: str, output_directory: str, segment_co
     
     segment_col_name
         The name of the column representing the chunk of text containing the pair of biomolecules.
+
+    max_tokens
+        Segments are sorted by length and batched so each padded batch holds at most this many tokens. Lower it if
+        memory runs out. Default is 16384.
+
+    engine
+        "trainer" to predict with a transformers `Trainer`, or "torch" to predict with a `BertPredictor`, which
+        skips the Trainer's setup and does not write checkpoints or logs, or "onnx" to predict on CPU with ONNX Runtime
+        from a model exported by `export_bert_onnx` (see `OnnxBertPredictor`). For "onnx", model_path may be the
+        model folder or the ONNX file, or "multi_pair" to encode each distinct segment once and score all of its pairs
+        from that pass (see `MultiPairBertPredictor`), which is faster for sentences with many terms. The "multi_pair"
+        engine needs a model fine-tuned with `fine_tune_multi_pair`, unless approximate is True. Default is "trainer".
+
+    device
+        The device for the "torch" engine. See `BertPredictor`.
+
+    num_threads
+        The number of CPU threads for the "torch" and "onnx" engines. See `BertPredictor`. With more than one process,
+        the number of threads of each worker.
+
+    batch_size
+        An optional maximum number of segments in a batch. For the "trainer" engine, per_device_eval_batch_size is
+        used if batch_size is not given.
+
+    num_workers
+        The number of DataLoader workers for the "torch" engine. Default is 0.
+
+    prefetch_factor
+        The number of batches each worker prepares in advance for the "torch" engine.
     
+    chunk_size
+        If set, read the input this many rows at a time and append each chunk's results to the output as soon as it is
+        scored. Progress is recorded in "bert_results_checkpoint.json" in the output directory, and a restarted run
+        with the same input, model files, chunk size, engine, quantization, and prefilter skips the chunks that are
+        already scored. Otherwise, the run starts over. Default is None, which scores the whole input at once.
+
+    quantize
+        If True, run an int8 quantized copy of the model on CPU. Only used by the "torch" and "multi_pair" engines. See
+        `BertPredictor` and check the agreement with the full model with `quantization_agreement`. Default is False.
+
+    cache_path
+        An optional path to a SQLite prediction cache (see `PredictionCache`). Inputs that this model has scored
+        before, in this run or an earlier one, are read from the cache, and only new inputs are scored. Default is None.
+
+    n_processes
+        The number of processes to score with on CPU, each with its own copy of the model, for the "torch" and "onnx"
+        engines. Not to be confused with num_workers, which only forms batches. See `ShardedBertPredictor`. Scripts
+        using more than 1 process must be run under `if __name__ == "__main__":`. Default is 1.
+
+    prefilter
+        An optional `PairPrefilter`, or the directory one was saved to. Only the pairs it scores at or above its
+        threshold are sent to BERT, and the pairs it skips are left out of the results. Default is None.
+
+    prefilter_threshold
+        The threshold of the prefilter. Default is None, which uses the threshold set when the prefilter was fit.
+
+    approximate
+        If True, let the "multi_pair" engine score with a model that was not fine-tuned with `fine_tune_multi_pair`.
+        Its scores are approximate. Default is False.
+
     **kwargz
-        Any additional arguments to pass to `TrainingArguments`.
+        Any additional arguments to pass to `TrainingArguments`. Only used by the "trainer" engine.
     
     Returns
     -------
         Writes a csv file containing the results of the model.
     """
 
-    CLASSES = ["0", "1"]
+    if engine not in _ENGINES:
+        raise Exception("engine must be one of: " + ", ".join(_ENGINES))
+    if chunk_size is not None and chunk_size < 1:
+        raise Exception("chunk_size must be a positive number of rows")
+    if quantize and engine not in ["torch", "multi_pair"]:
+        raise Exception("quantize is only supported by the torch and multi_pair engines")
+    if n_processes > 1 and engine not in _SHARDED_ENGINES:
+        raise Exception("n_processes above 1 is only supported by the " + " and ".join(_SHARDED_ENGINES) + " engines")
 
-    tokenizer = BertTokenizer.from_pretrained(
-        "dmis-lab/biobert-base-cased-v1.2"
-    )
+    cache = PredictionCache(cache_path) if cache_path is not None else None
 
-    model = BertSrcClassifier.from_pretrained(
-        model_path,
-        num_labels=len(CLASSES),
-        mask_token_id=tokenizer.mask_token_id,
-    )
+    # The worker pool of a sharded predictor and the cache are closed even if the setup fails
+    predictor = None
+    try:
+        if engine in _PREDICTOR_ENGINES:
+            predictor = _load_predictor(model_path, engine, device, num_threads, quantize, cache, n_processes, approximate = approximate)
+            score = lambda table: predictor.predict(table, segment_col_name, max_tokens, batch_size, num_workers, prefetch_factor)
+        else:
+            tokenizer = BertTokenizer.from_pretrained(
+                "dmis-lab/biobert-base-cased-v1.2"
+            )
 
-    test = pd.read_csv(input_path)
-    test = __make_bert_ready(test, segment_col_name)
-    test_dataset = __preprocess_data(test, tokenizer, x_col = "Sentence", y_col = "Guess", e1_col = "Term1", e2_col = "Term2")
+            model = BertSrcClassifier.from_pretrained(
+                model_path,
+                num_labels=2,
+                mask_token_id=tokenizer.mask_token_id,
+            )
 
-    training_args = TrainingArguments(
-        output_dir="./checkpoints",
-        logging_dir="./logs",
-        **kwargz
-    )
+            training_args = TrainingArguments(
+                output_dir="./checkpoints",
+                logging_dir="./logs",
+                **kwargz
+            )
 
-    trainer = Trainer(
-        model=model,
-        args=training_args,
-        eval_dataset=test_dataset,
-    )
+            # The batch sampler is replaced for each table that is scored
+            trainer = _BucketedTrainer(
+                batch_sampler=None,
+                model=model,
+                args=training_args,
+                data_collator=DataCollatorWithPadding(tokenizer),
+            )
+            fingerprint = model_fingerprint(model_path, "dmis-lab/biobert-base-cased-v1.2") if cache is not None else None
+
+            # A per_device_eval_batch_size passed to TrainingArguments still caps the batches
+            max_batch_size = batch_size if batch_size is not None else kwargz.get("per_device_eval_batch_size")
+            score = lambda table: _predict_with_trainer(trainer, tokenizer, table, segment_col_name, max_tokens, cache, fingerprint,
+                                                        max_batch_size)
+
+        # Everything that changes the results is part of the checkpoint of a chunked run, so a run resumed with other
+        # settings or a changed model starts over
+        settings = {"engine": engine, "quantize": quantize, "approximate": approximate, "prefilter": None, "prefilter_threshold": None}
+        if chunk_size is not None:
+            fingerprint_path = model_path
+            if engine == "onnx":
+                from .bert_onnx import _resolve_onnx_path
+                fingerprint_path = _resolve_onnx_path(model_path)
+            settings["model_fingerprint"] = model_fingerprint(fingerprint_path)
 
-    trainer_out = trainer.predict(test_dataset)
+        if prefilter is not None:
+            from .prefilter import PairPrefilter
+            if isinstance(prefilter, PairPrefilter) == False:
+                prefilter = PairPrefilter.load(prefilter)
+            threshold = prefilter.threshold if prefilter_threshold is None else prefilter_threshold
+            settings.update({"prefilter": prefilter._fingerprint(), "prefilter_threshold": threshold})
+            model_score = score
+            score = lambda table: model_score(prefilter.filter(table, segment_col_name, threshold))
 
-    probs = nn.functional.softmax(torch.from_numpy(trainer_out.predictions), dim = -1)
-    test[["True Negative", "True Positive"]] = pd.DataFrame(probs)
-    test = test.drop("Guess", axis = 1)
-    test.to_csv(os.path.join(output_directory, "bert_results.txt"), sep = '\t', index = False, header = True)
+        __write_bert_results(score, input_path, model_path, output_directory, segment_col_name, chunk_size, settings)
+    finally:
+        if predictor is not None and n_processes > 1:
+            predictor.close()
+        if cache is not None:
+            cache.close()
 
-    return(None)
\ No newline at end of file
+    return(None)
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import torch
+from torch import nn
+from transformers import BertTokenizer, DataCollatorWithPadding
+
+from .bert_functions import BertSrcClassifier, BertPredictor, SrcDataset, TokenBudgetBatchSampler
+from .bert_cache import PredictionCache
+
+# Name of the exported model within a model folder
+_ONNX_FILENAME = "bert_src.onnx"
+
+# Inputs of the exported graph
+_ONNX_INPUTS = ["input_ids", "attention_mask", "token_type_ids"]
+
+def _resolve_onnx_path(model_path: str):
+    """
+    The path of an ONNX model, given the model itself or the model folder it was exported to
+    """
+    if os.path.isdir(model_path):
+        model_path = os.path.join(model_path, _ONNX_FILENAME)
+    if os.path.exists(model_path) == False:
+        raise Exception(model_path + " does not exist. Export the model with export_bert_onnx first.")
+    return model_path
+
+class _OnnxSrcModule(nn.Module):
+    """
+    BertSrcClassifier for export. The hidden states of the [MASK] tokens (and [CLS], for three output layers) are
+    gathered by position rather than by boolean indexing, so the pooling is a fixed-shape part of the graph, and
+    the graph returns class probabilities.
+    """
+    def __init__(self, model: BertSrcClassifier):
+        super().__init__()
+        if model.n_output_layer not in [2, 3]:
+            raise Exception("Only models that pool [MASK] tokens (num_token_layer of 2 or 3) can be exported")
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor):
+        hidden = self.model.bert(input_ids, attention_mask = attention_mask, token_type_ids = token_type_ids, return_dict = True).last_hidden_state
+
+        check = input_ids == self.model.mask_token_id
+        if self.model.n_output_layer == 3:
+            check = torch.cat([torch.ones_like(check[:, :1]), check[:, 1:]], dim = 1)
+
+        # The position of the first, second (and third) pooled token of each sequence
+        rank = torch.cumsum(check.to(torch.int64), dim = 1)
+        positions = torch.stack([torch.argmax((check & (rank == k)).to(torch.int64), dim = 1) for k in range(1, self.model.n_output_layer + 1)], dim = 1)
+        pooled = torch.gather(hidden, 1, positions.unsqueeze(-1).expand(-1, -1, hidden.shape[-1]))
+
+        output = self.model.dense(pooled.reshape(hidden.shape[0], -1))
+        output = self.model.activation(output)
+        return nn.functional.softmax(self.model.classifier(output), dim = -1)
+
+def export_bert_onnx(model_path: str, output_path: str = None, tokenizer_name: str = "dmis-lab/biobert-base-cased-v1.2"):
+    """
+    Export a fine-tuned BertSrcClassifier to ONNX, including the [MASK] token pooling head, so it can be run on CPU
+    with ONNX Runtime by `run_bert(engine = "onnx")` or an `OnnxBertPredictor`. Batch size and sequence length
+    are dynamic. Requires the onnx package.
+
+    Parameters
+    ----------
+    model_path
+        A path to the folder containing the BERT model. See `run_bert`.
+
+    output_path
+        The path to write the ONNX model to. Default is None, which writes "bert_src.onnx" into the model folder.
+
+    tokenizer_name
+        The name or path of the tokenizer. Default is "dmis-lab/biobert-base-cased-v1.2".
+
+    Returns
+    -------
+        The path of the ONNX model
+    """
+
+    try:
+        import onnx
+    except:
+        raise Exception("To export to ONNX, install onnx and onnxscript.")
+
+    if output_path is None:
+        output_path = os.path.join(model_path, _ONNX_FILENAME)
+
+    tokenizer = BertTokenizer.from_pretrained(tokenizer_name)
+    model = BertSrcClassifier.from_pretrained(model_path, num_labels = 2, mask_token_id = tokenizer.mask_token_id)
+    model.eval()
+
+    # Trace with a batch of two sequences with two masked terms each
+    example = tokenizer(["[MASK] binds @TERM$2"] * 2, ["@TERM$1 binds [MASK]"] * 2, return_tensors = "pt")
+    inputs = tuple(example[key] for key in _ONNX_INPUTS)
+
+    dynamic_axes = {key: {0: "batch", 1: "sequence"} for key in _ONNX_INPUTS}
+    dynamic_axes["probs"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(_OnnxSrcModule(model), inputs, output_path, input_names = _ONNX_INPUTS, output_names = ["probs"],
+                          dynamic_axes = dynamic_axes)
+    return output_path
+
+class OnnxBertPredictor(BertPredictor):
+    """
+    Scores tables of sentence segments on CPU with ONNX Runtime, from a model written by `export_bert_onnx`. Takes
+    the same tables and returns the same results as `BertPredictor`. Requires the onnxruntime package.
+
+    Parameters
+    ----------
+    model_path
+        A path to the ONNX model, or to a model folder holding the "bert_src.onnx" written by `export_bert_onnx`.
+
+    num_threads
+        The number of threads ONNX Runtime uses within operations. Default is None, which uses all cores.
+
+    tokenizer_name
+        The name or path of the tokenizer. Default is "dmis-lab/biobert-base-cased-v1.2".
+
+    cache
+        An optional PredictionCache. See `BertPredictor`.
+    """
+    def __init__(self, model_path: str, num_threads: int = None, tokenizer_name: str = "dmis-lab/biobert-base-cased-v1.2",
+                 cache: PredictionCache = None):
+        try:
+            import onnxruntime
+        except:
+            raise Exception("To use the onnx engine, install onnxruntime.")
+
+        model_path = _resolve_onnx_path(model_path)
+        super().__init__(model_path, device = "cpu", tokenizer_name = tokenizer_name, cache = cache, model_class = None)
+        self.collator = DataCollatorWithPadding(self.tokenizer, return_tensors = "np")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers = ["CPUExecutionProvider"])
+
+    def _score_dataset(self, dataset: SrcDataset, max_tokens: int, batch_size: int, num_workers: int, prefetch_factor: int):
+        # Batches are formed in this process, so num_workers and prefetch_factor are not used
+        batch_sampler = TokenBudgetBatchSampler(dataset.lengths(), max_tokens = max_tokens, max_batch_size = batch_size)
+
+        batch_probs = []
+        for batch in batch_sampler:
+            features = self.collator([{key: dataset.encodings[key][index] for key in _ONNX_INPUTS} for index in batch])
+            batch_probs.append(self.session.run(None, {key: features[key].astype(np.int64) for key in _ONNX_INPUTS})[0])
+
+        # Put predictions back in the order of the rows
+        probs = np.zeros((len(dataset), 2), dtype = np.float32)
+        if len(batch_probs) > 0:
+            probs[batch_sampler.order()] = np.concatenate(batch_probs)
+        return probs
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import queue
+import threading
+import requests
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .bert_functions import BertPredictor, PredictionCache, _load_predictor, _PREDICTOR_ENGINES
+
+class _Request:
+    """
+    A table waiting to be scored by the server's batching thread
+    """
+    def __init__(self, table: pd.DataFrame, segment_col_name: str):
+        self.table = table
+        self.segment_col_name = segment_col_name
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class _BertRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles POST /predict with a table of pairs and GET /health. Each request waits for its batch to be scored.
+    """
+    def _respond(self, status: int, body: dict):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._respond(200, {"status": "ok"})
+        else:
+            self._respond(404, {"error": "Unknown path " + self.path})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._respond(404, {"error": "Unknown path " + self.path})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            table = pd.DataFrame(payload["table"]["data"], columns = payload["table"]["columns"])
+            request = _Request(table, payload["segment_col_name"])
+        except Exception as e:
+            self._respond(400, {"error": "Invalid request: " + str(e)})
+            return
+
+        self.server.bert_server.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            self._respond(500, {"error": request.error})
+        else:
+            self._respond(200, {"table": request.result.to_dict(orient = "split")})
+
+    def log_message(self, format, *args):
+        pass
+
+class BertServer:
+    """
+    Keeps a BertPredictor (and its tokenizer) loaded and serves predictions over localhost HTTP, so scripts and
+    notebooks that score small tables do not reload the model for every call. Tables that arrive within max_wait
+    seconds of each other are scored together in one batch. Query it with a `BertClient` or `run_bert_client`.
+
+    Parameters
+    ----------
+    predictor
+        A BertPredictor or OnnxBertPredictor.
+
+    host
+        The address to listen on. Default is "127.0.0.1", which only accepts connections from this machine.
+
+    port
+        The port to listen on. Default is 8765. Use 0 to pick any free port.
+
+    max_wait
+        The longest time in seconds to wait for more tables before scoring a batch. Default is 0.01.
+
+    max_batch_rows
+        A batch is scored as soon as it holds this many rows. Default is 1024.
+
+    max_tokens
+        The maximum number of tokens in a padded batch. See `TokenBudgetBatchSampler`. Default is 16384.
+    """
+    def __init__(self, predictor: BertPredictor, host: str = "127.0.0.1", port: int = 8765, max_wait: float = 0.01,
+                 max_batch_rows: int = 1024, max_tokens: int = 16384):
+        self.predictor = predictor
+        self.max_wait = max_wait
+        self.max_batch_rows = max_batch_rows
+        self.max_tokens = max_tokens
+        self.queue = queue.Queue()
+        self.httpd = ThreadingHTTPServer((host, port), _BertRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.bert_server = self
+        self._threads = []
+
+    @property
+    def url(self):
+        """
+        The address of the server, such as "http://127.0.0.1:8765"
+        """
+        host, port = self.httpd.server_address[:2]
+        return "http://" + host + ":" + str(port)
+
+    def _batch_loop(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+
+            # Gather tables until the batch is full or the wait is over
+            batch = [request]
+            rows = len(request.table)
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_rows:
+                try:
+                    request = self.queue.get(timeout = max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)
+                    break
+                batch.append(request)
+                rows += len(request.table)
+
+            # Only tables with the same columns can be scored together
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.segment_col_name, tuple(request.table.columns)), []).append(request)
+            for group in groups.values():
+                self._score(group)
+
+    def _score(self, batch: list[_Request]):
+        try:
+            table = pd.concat([request.table for request in batch], ignore_index = True)
+            scored = self.predictor.predict(table, batch[0].segment_col_name, self.max_tokens)
+
+            # Split the results back into the tables they came from
+            start = 0
+            for request in batch:
+                end = start + len(request.table)
+                result = scored[(scored.index >= start) & (scored.index < end)]
+                request.result = result.set_axis(result.index - start, axis = 0)
+                start = end
+        except Exception as e:
+            for request in batch:
+                request.error = str(e)
+        for request in batch:
+            request.done.set()
+
+    def start(self):
+        """
+        Serve in background threads and return immediately
+
+        Returns
+        -------
+            The BertServer
+        """
+        for target in [self._batch_loop, self.httpd.serve_forever]:
+            thread = threading.Thread(target = target, daemon = True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def serve_forever(self):
+        """
+        Serve until interrupted
+        """
+        batcher = threading.Thread(target = self._batch_loop, daemon = True)
+        batcher.start()
+        self._threads.append(batcher)
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Stop serving and close the port
+        """
+        self.queue.put(None)
+        if len(self._threads) > 0:
+            self.httpd.shutdown()
+        self.httpd.server_close()
+
+def serve_bert(model_path: str, host: str = "127.0.0.1", port: int = 8765, engine: str = "torch", device: str = None,
+               num_threads: int = None, quantize: bool = False, cache_path: str = None, max_wait: float = 0.01,
+               max_batch_rows: int = 1024, max_tokens: int = 16384, verbose: bool = True, approximate: bool = False):
+    """
+    Load the BERT model once and serve predictions on localhost until interrupted. Score tables against it with
+    `run_bert_client` or a `BertClient` from any script or notebook on the same machine.
+
+    Parameters
+    ----------
+    model_path
+        A path to the folder containing the BERT model. See `run_bert`.
+
+    host
+        The address to listen on. Default is "127.0.0.1".
+
+    port
+        The port to listen on. Default is 8765.
+
+    engine
+        "torch", "onnx", or "multi_pair". See `run_bert`. Default is "torch".
+
+    device
+        The device for the "torch" engine. See `BertPredictor`.
+
+    num_threads
+        The number of CPU threads. See `BertPredictor`.
+
+    quantize
+        If True, serve an int8 quantized model with the "torch" or "multi_pair" engine. See `BertPredictor`. Default is False.
+
+    cache_path
+        An optional path to a SQLite prediction cache. See `run_bert`.
+
+    max_wait
+        The longest time in seconds to wait for more tables before scoring a batch. Default is 0.01.
+
+    max_batch_rows
+        A batch is scored as soon as it holds this many rows. Default is 1024.
+
+    max_tokens
+        The maximum number of tokens in a padded batch. See `TokenBudgetBatchSampler`. Default is 16384.
+
+    verbose
+        If True, print the address once the server is ready. Default is True.
+
+    approximate
+        If True, let the "multi_pair" engine serve a model that was not fine-tuned for it. See `run_bert`. Default is False.
+    """
+
+    if engine not in _PREDICTOR_ENGINES:
+        raise Exception("engine must be one of: " + ", ".join(_PREDICTOR_ENGINES))
+    if quantize and engine not in ["torch", "multi_pair"]:
+        raise Exception("quantize is only supported by the torch and multi_pair engines")
+
+    cache = PredictionCache(cache_path) if cache_path is not None else None
+    predictor = _load_predictor(model_path, engine, device, num_threads, quantize, cache, approximate = approximate)
+    server = BertServer(predictor, host, port, max_wait, max_batch_rows, max_tokens)
+    if verbose:
+        print("Serving BERT predictions at " + server.url)
+    try:
+        server.serve_forever()
+    finally:
+        if cache is not None:
+            cache.close()
+
+class BertClient:
+    """
+    Scores tables with a model served by `serve_bert` or a `BertServer`.
+
+    Parameters
+    ----------
+    url
+        The address of the server. Default is "http://127.0.0.1:8765".
+
+    timeout
+        Seconds to wait for each response. Default is 600.
+    """
+    def __init__(self, url: str = "http://127.0.0.1:8765", timeout: float = 600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def predict(self, table: pd.DataFrame, segment_col_name: str = "segment", request_rows: int = 10000):
+        """
+        Score a table from `find_terms_in_papers`, as `BertPredictor.predict` does.
+
+        Parameters
+        ----------
+        table
+            A table of sentence segments with term_1 and term_2 columns.
+
+        segment_col_name
+            The name of the column representing the chunk of text containing the pair of biomolecules. Default is "segment".
+
+        request_rows
+            Large tables are sent this many rows at a time. Default is 10000.
+
+        Returns
+        -------
+            The scored rows with "True Negative" and "True Positive" columns, as written by `run_bert`
+        """
+        results = []
+        for start in range(0, max(len(table), 1), request_rows):
+            part = table.iloc[start:start + request_rows]
+            response = requests.post(self.url + "/predict", timeout = self.timeout, json = {
+                "segment_col_name": segment_col_name,
+                "table": {"columns": part.columns.tolist(), "data": part.astype(object).where(part.notna(), None).values.tolist()}
+            })
+            if response.status_code != 200:
+                raise Exception("The BERT server returned an error: " + response.json().get("error", response.text))
+            result = response.json()["table"]
+            result = pd.DataFrame(result["data"], columns = result["columns"], index = result["index"])
+
+            # Put back the labels of the rows that were sent
+            results.append(result.set_axis(part.index[result.index.to_numpy(dtype = int)], axis = 0))
+        return pd.concat(results)
+
+def run_bert_client(input_path: str, output_directory: str, segment_col_name: str, url: str = "http://127.0.0.1:8765",
+                    request_rows: int = 10000):
+    """
+    Score a CSV file with a model served by `serve_bert`, writing the same "bert_results.txt" as `run_bert`.
+
+    Parameters
+    ----------
+    input_path
+        A path to the CSV file to run the model on. Should be a result of `find_terms_in_papers`
+
+    output_directory
+        A path where to write the results to
+
+    segment_col_name
+        The name of the column representing the chunk of text containing the pair of biomolecules.
+
+    url
+        The address of the server. Default is "http://127.0.0.1:8765".
+
+    request_rows
+        The file is sent this many rows at a time. Default is 10000.
+
+    Returns
+    -------
+        Writes a csv file containing the results of the model.
+    """
+
+    test = BertClient(url).predict(pd.read_csv(input_path), segment_col_name, request_rows)
+    test.to_csv(os.path.join(output_directory, "bert_results.txt"), sep = '\t', index = False, header = True)
+    return(None)
@@ -0,0 +1,202 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .term_matcher import _join_strings, _split_strings
+
+# Scoring methods for score_cooccurrence
+_SCORING_METHODS = ["pmi", "npmi", "chi2"]
+
+# Levels at which co-occurrence is counted, and the file each is saved to
+_LEVELS = {"sentence": "term_cooccurrence_sentence.npz", "paper": "term_cooccurrence_paper.npz"}
+
+class CooccurrenceMatrix:
+    """
+    Sparse term-by-term counts of how many sentences and how many papers each pair of terms appears in together.
+    Both matrices are symmetric, and the diagonal holds the number of sentences (or papers) with each term.
+    Made by `find_terms_in_papers(cooccurrence = True)` and scored with `score_cooccurrence`.
+
+    Parameters
+    ----------
+    terms
+        The terms of each row and column.
+
+    sentence_counts
+        A scipy CSR matrix of sentence-level counts.
+
+    paper_counts
+        A scipy CSR matrix of paper-level counts.
+
+    n_sentences
+        The number of sentences counted.
+
+    n_papers
+        The number of papers counted.
+    """
+    def __init__(self, terms: list[str], sentence_counts: sparse.csr_matrix, paper_counts: sparse.csr_matrix,
+                 n_sentences: int, n_papers: int):
+        self.terms = terms
+        self.sentence_counts = sentence_counts
+        self.paper_counts = paper_counts
+        self.n_sentences = n_sentences
+        self.n_papers = n_papers
+
+    def __len__(self):
+        return len(self.terms)
+
+    def save(self, directory: str):
+        """
+        Write both matrices to a directory as "term_cooccurrence_sentence.npz" and "term_cooccurrence_paper.npz".
+        Each file can also be read on its own with `scipy.sparse.load_npz`.
+
+        Parameters
+        ----------
+        directory
+            Path to the directory to write to. It is created if it does not exist.
+        """
+        if os.path.exists(directory) == False:
+            os.mkdir(directory, mode = 0o777)
+        for level, counts, n_units in [("sentence", self.sentence_counts, self.n_sentences), ("paper", self.paper_counts, self.n_papers)]:
+            np.savez_compressed(os.path.join(directory, _LEVELS[level]), format = np.array(b"csr"), shape = np.array(counts.shape),
+                                data = counts.data, indices = counts.indices, indptr = counts.indptr,
+                                terms = _join_strings(self.terms), n_terms = np.array(len(self.terms)), n_units = np.array(n_units))
+
+    @classmethod
+    def load(cls, directory: str):
+        """
+        Load matrices written by `save`.
+
+        Parameters
+        ----------
+        directory
+            Path to the directory the matrices were saved to.
+
+        Returns
+        -------
+            A CooccurrenceMatrix
+        """
+        counts, n_units = {}, {}
+        for level, filename in _LEVELS.items():
+            with np.load(os.path.join(directory, filename)) as loaded:
+                counts[level] = sparse.csr_matrix((loaded["data"], loaded["indices"], loaded["indptr"]), shape = tuple(loaded["shape"]))
+                n_units[level] = int(loaded["n_units"])
+                terms = _split_strings(loaded["terms"], int(loaded["n_terms"]))
+        return cls(terms, counts["sentence"], counts["paper"], n_units["sentence"], n_units["paper"])
+
+class _CooccurrenceCounter:
+    """
+    Accumulate co-occurrence counts paper by paper. Pairs are held as coordinate lists and summed into the upper
+    triangle of a CSR matrix whenever flush_size of them are held in memory.
+    """
+    def __init__(self, n_terms: int, flush_size: int = 1000000):
+        self.n_terms = n_terms
+        self.flush_size = flush_size
+        self.n_sentences = 0
+        self.n_papers = 0
+        self._pairs = {level: ([], []) for level in _LEVELS}
+        self._counts = {level: sparse.csr_matrix((n_terms, n_terms), dtype = np.int64) for level in _LEVELS}
+
+    def _add(self, level: str, terms: list[int]):
+        rows, cols = self._pairs[level]
+        for position, term in enumerate(terms):
+            rows.extend([term] * (len(terms) - position))
+            cols.extend(terms[position:])
+        if len(rows) >= self.flush_size:
+            self._flush(level)
+
+    def _flush(self, level: str):
+        rows, cols = self._pairs[level]
+        if len(rows) > 0:
+            self._counts[level] += sparse.csr_matrix((np.ones(len(rows), dtype = np.int64), (rows, cols)),
+                                                     shape = (self.n_terms, self.n_terms))
+        self._pairs[level] = ([], [])
+
+    def add_paper(self, sentence_terms: list[list[int]]):
+        """
+        Count one paper, given the sorted, unique term indices found in each of its sentences.
+        """
+        paper_terms = set()
+        for terms in sentence_terms:
+            self._add("sentence", terms)
+            paper_terms.update(terms)
+        self._add("paper", sorted(paper_terms))
+        self.n_sentences += len(sentence_terms)
+        self.n_papers += 1
+
+    def result(self, terms: list[str]):
+        """
+        Return the counts as a CooccurrenceMatrix with symmetric matrices.
+        """
+        counts = {}
+        for level in _LEVELS:
+            self._flush(level)
+            upper = self._counts[level]
+            counts[level] = (upper + sparse.triu(upper, k = 1).T).tocsr()
+        return CooccurrenceMatrix(terms, counts["sentence"], counts["paper"], self.n_sentences, self.n_papers)
+
+def score_cooccurrence(matrix: CooccurrenceMatrix, level: str = "sentence", method: str = "pmi", min_count: int = 1):
+    """
+    Score every pair of terms that appear together by how much more often they co-occur than expected by chance.
+    Scores are computed for all pairs at once, so millions of sentences score in seconds. Use them to rank or
+    threshold pairs before running `run_bert`.
+
+    Parameters
+    ----------
+    matrix
+        A CooccurrenceMatrix from `find_terms_in_papers(cooccurrence = True)` or `CooccurrenceMatrix.load`.
+
+    level
+        Either "sentence" or "paper" to score sentence-level or paper-level counts. Default is "sentence".
+
+    method
+        "pmi" for pointwise mutual information, "npmi" for PMI normalized to range from -1 to 1, or "chi2" for the
+        chi-square statistic of the 2x2 table of units with and without each term. Default is "pmi".
+
+    min_count
+        Pairs that appear together in fewer than this many sentences (or papers) are not scored. Default is 1.
+
+    Returns
+    -------
+        A Pandas DataFrame with term_1, term_2, count (units with both terms), term_1_count, term_2_count, and score
+        columns, sorted from highest to lowest score.
+    """
+
+    if level not in _LEVELS:
+        raise Exception("level must be one of: " + ", ".join(_LEVELS))
+    if method not in _SCORING_METHODS:
+        raise Exception("method must be one of: " + ", ".join(_SCORING_METHODS))
+
+    counts = matrix.sentence_counts if level == "sentence" else matrix.paper_counts
+    n_units = float(matrix.n_sentences if level == "sentence" else matrix.n_papers)
+
+    # Each pair once, from the upper triangle. The diagonal holds the count of each term.
+    marginals = counts.diagonal().astype(float)
+    pairs = sparse.triu(counts, k = 1).tocoo()
+    keep = pairs.data >= min_count
+    row, col = pairs.row[keep], pairs.col[keep]
+    joint = pairs.data[keep].astype(float)
+    count_1, count_2 = marginals[row], marginals[col]
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        if method == "chi2":
+            # Cells of the 2x2 table: both terms, only term 1, only term 2, and neither
+            both, only_1, only_2 = joint, count_1 - joint, count_2 - joint
+            neither = n_units - count_1 - count_2 + joint
+            denominator = count_1 * count_2 * (n_units - count_1) * (n_units - count_2)
+            score = np.where(denominator > 0, n_units * (both * neither - only_1 * only_2) ** 2 / denominator, 0.0)
+        else:
+            score = np.log(joint * n_units / (count_1 * count_2))
+            if method == "npmi":
+                score = np.where(joint < n_units, score / -np.log(joint / n_units), 1.0)
+
+    terms = np.array(matrix.terms, dtype = object)
+    scores = pd.DataFrame({
+        "term_1": terms[row],
+        "term_2": terms[col],
+        "count": pairs.data[keep],
+        "term_1_count": count_1.astype(np.int64),
+        "term_2_count": count_2.astype(np.int64),
+        "score": score
+    })
+    return scores.sort_values("score", ascending = False, kind = "stable").reset_index(drop = True)
@@ -1,6 +1,10 @@
 import os
+import json
+import hashlib
+import numpy as np
 import pandas as pd
-import re
+
+from .sentence_cache import _read_paper_sentences, sentence_spans
 
 # Build a support function to get directories 
 def __get_all_files(directory: str):
@@ -27,6 +31,291 @@ def __get_all_files(directory: str):
 
     return file_paths
 
+def __chunk_windows(content: str, spans: list[tuple[int, int]], chunk_size: int, chunk_overlap: int):
+    '''
+    Pack consecutive sentences into chunks of at most chunk_size characters, splitting longer sentences at whitespace.
+    Each chunk is then extended backwards by up to chunk_overlap characters, preferably by whole sentences, so an
+    entity crossing into a chunk is seen in full.
+
+    Returns
+    -------
+        A list of (start, end, core_start) character offsets of each chunk, where the chunk's own text begins at core_start
+    '''
+
+    # Split sentences that are too long on their own
+    units = []
+    for start, end in spans:
+        while end - start > chunk_size:
+            cut = max(content.rfind(" ", start + 1, start + chunk_size), content.rfind("\n", start + 1, start + chunk_size))
+            if cut <= start:
+                cut = start + chunk_size
+            units.append((start, cut))
+            start = cut
+        units.append((start, end))
+
+    windows = []
+    first = 0
+    while first < len(units):
+
+        # Take sentences until the chunk is full
+        last = first
+        while last + 1 < len(units) and units[last + 1][1] - units[first][0] <= chunk_size:
+            last += 1
+
+        # Add previous sentences that fit within the overlap. If the previous sentence is too long, start the chunk
+        # at whitespace within the overlap instead.
+        overlap = first
+        while overlap > 0 and units[first][0] - units[overlap - 1][0] <= chunk_overlap:
+            overlap -= 1
+        start = units[overlap][0]
+        if overlap == first and first > 0 and chunk_overlap > 0:
+            space = content.find(" ", max(units[first - 1][0], start - chunk_overlap), start)
+            if space >= 0:
+                start = space + 1
+
+        windows.append((start, units[last][1], units[first][0]))
+        first = last + 1
+
+    return windows
+
+def __stream_texts(paper_list: list[str], cache_directory: str, tokenizer: str, chunk_size: int, chunk_overlap: int,
+                   verbose: bool):
+    '''
+    Read one file at a time and yield the text of each paper, each of its sentences when a sentence cache is used,
+    or each of its chunks when a chunk_size is given. Texts are paired with the paper, the offset of the text in
+    the paper, and the range of the paper in which entities ending belong to the text.
+    '''
+    for file in paper_list:
+
+        if verbose:
+            print("On paper...", file)
+
+        if cache_directory is None and chunk_size is None:
+            with open(file, "r") as info:
+                content = info.read()
+            yield content, (file, 0, 0, len(content) + 1)
+            continue
+
+        # Split into sentences, from the cache if possible
+        if cache_directory is not None:
+            paper = _read_paper_sentences(file, cache_directory, tokenizer)
+            content, spans = paper["content"], paper["raw_spans"]
+        else:
+            with open(file, "r") as info:
+                content = info.read()
+            spans = sentence_spans(content, tokenizer)
+
+        if chunk_size is None:
+            for start, end in spans:
+                yield content[start:end], (file, start, start, end + 1)
+            continue
+
+        # Each chunk owns the entities that end from its own start up to the start of the next chunk. An entity cut
+        # off at the end of a chunk is found in full by the next chunk instead.
+        windows = __chunk_windows(content, spans, chunk_size, chunk_overlap)
+        for position, (start, end, core_start) in enumerate(windows):
+            core_end = windows[position + 1][2] if position + 1 < len(windows) else len(content) + 1
+            yield content[start:end], (file, start, core_start, core_end)
+
+def __paper_entities(nlp, texts, batch_size: int, n_process: int):
+    '''
+    Run the model over a stream of texts from `__stream_texts` and yield each paper with its entities as
+    (text, label, start, end) tuples, with offsets in the paper. Entities found twice in overlapping chunks are
+    only kept once.
+    '''
+    current, entities = None, []
+    for doc, (file, offset, own_start, own_end) in nlp.pipe(texts, as_tuples = True, batch_size = batch_size, n_process = n_process):
+        if file != current:
+            if current is not None:
+                yield current, entities
+            current, entities = file, []
+        for ent in doc.ents:
+            start, end = offset + ent.start_char, offset + ent.end_char
+            if own_start <= end < own_end:
+                entities.append((ent.text, ent.label_, start, end))
+    if current is not None:
+        yield current, entities
+
+def __entity_cache_path(entity_cache_directory: str, file: str, model_key: str):
+    '''
+    Path to the cached entities of a paper, keyed by the sha256 hash of its content and by the model and settings used.
+    '''
+    with open(file, "r") as info:
+        content_hash = hashlib.sha256(info.read().encode("utf-8")).hexdigest()
+    return os.path.join(entity_cache_directory, content_hash + "_" + model_key + ".npz")
+
+def __write_entity_cache(cache_path: str, entities: list[tuple]):
+    '''
+    Write the (text, label, start, end) entities of a paper to the entity cache.
+    '''
+    texts, labels, starts, ends = zip(*entities) if len(entities) > 0 else ([], [], [], [])
+
+    # Write to a temporary file first so an interrupted run never leaves a partial file
+    temp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez_compressed(f, text = np.array(texts, dtype = np.str_), label = np.array(labels, dtype = np.str_),
+                            start = np.array(starts, dtype = np.int64), end = np.array(ends, dtype = np.int64))
+    os.replace(temp_path, cache_path)
+
+def __read_entity_cache(cache_path: str):
+    '''
+    Read the (text, label, start, end) entities of a paper from the entity cache.
+    '''
+    with np.load(cache_path) as cached:
+        return list(zip(cached["text"].tolist(), cached["label"].tolist(), cached["start"].tolist(), cached["end"].tolist()))
+
+def __select_ner_pipes(nlp):
+    '''
+    Disable every pipeline component except the entity recognizer and the shared tok2vec layer if the recognizer listens to it.
+    '''
+    keep = ["ner"]
+    if "tok2vec" in nlp.pipe_names and "ner" in getattr(nlp.get_pipe("tok2vec"), "listening_components", []):
+        keep.append("tok2vec")
+    nlp.select_pipes(disable = [name for name in nlp.pipe_names if name not in keep])
+    return nlp
+
+def __scispacy_entities(paper_list: list[str], cache_directory: str, tokenizer: str, batch_size: int, n_process: int,
+                        chunk_size: int, chunk_overlap: int, entity_cache_directory: str, verbose: bool):
+    '''
+    Yield each paper with the (text, label, start, end) entities found in it by the en_ner_bionlp13cg_md model,
+    reading them from the entity cache when possible. See `extract_terms_scispacy`.
+    '''
+
+    try:
+        import spacy
+        import scispacy
+        import en_ner_bionlp13cg_md
+    except:
+        raise Exception("To use this function, install spacy and scispacy. You must also pull the en_ner_bionlp13cg_md model. See the README for more details.")
+
+    # Search for terms throughout each paper, either all at once, sentence by sentence from the cache, or chunk by
+    # chunk, batching texts across papers. Only named entities are used, so the tagger, parser, and lemmatizer are not run.
+    if entity_cache_directory is None:
+        nlp_b13 = __select_ner_pipes(en_ner_bionlp13cg_md.load())
+        texts = __stream_texts(paper_list, cache_directory, tokenizer, chunk_size, chunk_overlap, verbose)
+        yield from __paper_entities(nlp_b13, texts, batch_size, n_process)
+        return
+
+    if os.path.exists(entity_cache_directory) == False:
+        os.mkdir(entity_cache_directory, mode = 0o777)
+
+    # Entities depend on the model and on how papers are split into texts
+    model_settings = {"model": "en_ner_bionlp13cg_md", "model_version": getattr(en_ner_bionlp13cg_md, "__version__", None),
+                      "spacy_version": spacy.__version__, "sentences": cache_directory is not None,
+                      "tokenizer": tokenizer, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+    if cache_directory is None and chunk_size is None:
+        model_settings["tokenizer"] = None
+    if chunk_size is None:
+        model_settings["chunk_overlap"] = None
+    model_key = hashlib.sha256(json.dumps(model_settings, sort_keys = True).encode()).hexdigest()[:16]
+
+    # Only run the model on papers missing from the cache
+    cache_paths = {file: __entity_cache_path(entity_cache_directory, file, model_key) for file in paper_list}
+    missing = [file for file in paper_list if os.path.exists(cache_paths[file]) == False]
+    if len(missing) > 0:
+        nlp_b13 = __select_ner_pipes(en_ner_bionlp13cg_md.load())
+        texts = __stream_texts(missing, cache_directory, tokenizer, chunk_size, chunk_overlap, verbose)
+        for file, entities in __paper_entities(nlp_b13, texts, batch_size, n_process):
+            __write_entity_cache(cache_paths[file], entities)
+
+        # Papers without any text have no entities
+        for file in missing:
+            if os.path.exists(cache_paths[file]) == False:
+                __write_entity_cache(cache_paths[file], [])
+
+    for file in paper_list:
+        yield file, __read_entity_cache(cache_paths[file])
+
+def __count_paper_terms(entities: list[tuple], tags: list[str], stop_words: set[str], min_length: int, max_length: int):
+    '''
+    Keep the entities of a paper with one of the tags, clean them into terms, and count each term and label.
+    Terms that are stop words or outside the length limits are removed.
+    '''
+
+    # Unwrap bionlp13cg labels
+    entities = pd.DataFrame(entities, columns = ["term", "label", "start", "end"])
+    entities = entities[entities["label"].isin(tags)]
+
+    # Clean terms and filter them all at once
+    terms = entities["term"].astype(str).str.lower().str.strip().str.replace(r"[^\s\d\w]|\n", '', regex = True)
+    keep = (terms.str.len() >= min_length) & (terms.str.len() <= max_length) & (terms.isin(stop_words) == False)
+    counts = entities.assign(term = terms)[keep].groupby(["term", "label"]).size()
+    return counts.reset_index(name = "count")
+
+def iter_terms_scispacy(paper_directory: str,
+                        omes_folder: str,
+                        tags: list[str] = ["GENE_OR_GENE_PRODUCT", "SIMPLE_CHEMICAL", "AMINO_ACID"],
+                        additional_stop_words: list[str] = None,
+                        min_length: int = 3,
+                        max_length: int = 100,
+                        cache_directory: str = None,
+                        tokenizer: str = "nltk",
+                        batch_size: int = 32,
+                        n_process: int = 1,
+                        chunk_size: int = None,
+                        chunk_overlap: int = 200,
+                        entity_cache_directory: str = None,
+                        verbose: bool = False):
+    '''
+    A generator version of `extract_terms_scispacy` that yields the terms found in each paper, with counts, as soon
+    as the paper is read. All parameters are the same as `extract_terms_scispacy`.
+
+    Returns
+    -------
+        A generator of (paper path, Pandas DataFrame) tuples, where the DataFrame has term, label, and count columns
+    '''
+
+    # Load stop words into a set
+    stop_words = set(pd.read_csv(os.path.join(omes_folder, "stop_words_english.txt"))["stopwords"].tolist())
+
+    if additional_stop_words is not None:
+        stop_words.update(additional_stop_words)
+
+    paper_entities = __scispacy_entities(__get_all_files(paper_directory), cache_directory, tokenizer, batch_size,
+                                         n_process, chunk_size, chunk_overlap, entity_cache_directory, verbose)
+    for file, entities in paper_entities:
+        yield file, __count_paper_terms(entities, tags, stop_words, min_length, max_length)
+
+def count_terms_scispacy(paper_directory: str,
+                         omes_folder: str,
+                         tags: list[str] = ["GENE_OR_GENE_PRODUCT", "SIMPLE_CHEMICAL", "AMINO_ACID"],
+                         additional_stop_words: list[str] = None,
+                         min_length: int = 3,
+                         max_length: int = 100,
+                         cache_directory: str = None,
+                         tokenizer: str = "nltk",
+                         batch_size: int = 32,
+                         n_process: int = 1,
+                         chunk_size: int = None,
+                         chunk_overlap: int = 200,
+                         entity_cache_directory: str = None,
+                         verbose: bool = False):
+    '''
+    Build a frequency table of the terms found in papers, to find rare or noisy terms before they are passed to
+    `find_terms_in_papers`. Papers are read one at a time, so only the table is held in memory. All parameters
+    are the same as `extract_terms_scispacy`.
+
+    Returns
+    -------
+        A Pandas DataFrame with the term, its label, document_frequency (the number of papers it is found in), and
+        total_count (the number of times it is found), sorted from most to least found
+    '''
+
+    # Hold the document frequency and total count of each term and label
+    frequencies = {}
+    paper_counts = iter_terms_scispacy(paper_directory, omes_folder, tags, additional_stop_words, min_length,
+                                       max_length, cache_directory, tokenizer, batch_size, n_process, chunk_size,
+                                       chunk_overlap, entity_cache_directory, verbose)
+    for _, counts in paper_counts:
+        for term, label, count in counts.itertuples(index = False):
+            frequency = frequencies.setdefault((term, label), [0, 0])
+            frequency[0] += 1
+            frequency[1] += count
+
+    table = pd.DataFrame([[term, label, document_frequency, total_count] for (term, label), (document_frequency, total_count) in frequencies.items()],
+                         columns = ["term", "label", "document_frequency", "total_count"])
+    return table.sort_values(["total_count", "term", "label"], ascending = [False, True, True]).reset_index(drop = True)
+
 # Extract unique terms from papers 
 def extract_terms_scispacy(paper_directory: str, 
                            omes_folder: str, 
@@ -34,6 +323,14 @@ def extract_terms_scispacy(paper_directory: str,
                            additional_stop_words: list[str] = None,
                            min_length: int = 3, 
                            max_length: int = 100,
+                           cache_directory: str = None,
+                           tokenizer: str = "nltk",
+                           batch_size: int = 32,
+                           n_process: int = 1,
+                           chunk_size: int = None,
+                           chunk_overlap: int = 200,
+                           entity_cache_directory: str = None,
+                           min_document_frequency: int = 1,
                            verbose: bool = False):
     '''
     Extract terms from papers
@@ -57,6 +354,42 @@ def extract_terms_scispacy(paper_directory: str,
     
     max_length
         The maximum number of characters allowed. Default is 100. 
+
+    cache_directory
+        An optional path to a sentence cache (see `cache_sentences`). If provided, papers are read from the cache
+        and passed to the model one sentence at a time instead of as one long text. Default is None.
+
+    tokenizer
+        The sentence splitter used with cache_directory or chunk_size, either "nltk" or "regex". See `sentence_spans`.
+        Default is "nltk".
+
+    batch_size
+        The number of texts (papers, sentences with cache_directory, or chunks with chunk_size) passed to the model
+        at once. Default is 32.
+
+    n_process
+        The number of processes to run the model with. On Windows and macOS, scripts using more than 1 process must
+        be run under `if __name__ == "__main__":`. Default is 1.
+
+    chunk_size
+        If provided, papers are split into chunks of whole sentences of at most this many characters (longer sentences
+        are split at whitespace), so memory use depends on the chunk size rather than the length of the paper, and
+        papers longer than spaCy's max_length can be read. Default is None, which passes each paper (or each cached
+        sentence) as one text.
+
+    chunk_overlap
+        The number of characters of preceding sentences repeated at the start of each chunk, so entities crossing a
+        chunk border are found in full. Each entity is kept once, from the chunk it ends in. Default is 200.
+
+    entity_cache_directory
+        An optional path to a directory to cache the entities (text, label, and offsets) found in each paper, keyed
+        by the paper's content hash, the model version, and the settings that change the entities (cache_directory,
+        tokenizer, chunk_size, and chunk_overlap). Papers in the cache are not run through the model again, so
+        changing tags, stop words, or length limits only re-filters the cached entities. Default is None.
+    
+    min_document_frequency
+        Terms found (with the same label) in fewer than this many papers are removed. See `count_terms_scispacy`.
+        Default is 1.
     
     verbose
         Indicate whether a message should be printed as each file is processed. Default is "FALSE"
@@ -66,60 +399,9 @@ def extract_terms_scispacy(paper_directory: str,
         A list of unique terms found in papers written as a string
     '''
 
-    # Pull papers
-    paper_list = __get_all_files(paper_directory)
-
-    try:
-        import spacy
-        import scispacy
-        import en_ner_bionlp13cg_md
-    except:
-        raise Exception("To use this function, install spacy and scispacy. You must also pull the en_ner_bionlp13cg_md model. See the README for more details.")
-
-
-    # Load the model
-    nlp_b13 = en_ner_bionlp13cg_md.load()
-
-    # Load stop words
-    stop_words = pd.read_csv(os.path.join(omes_folder, "stop_words_english.txt"))["stopwords"].tolist()
-
-    if additional_stop_words is not None:
-        stop_words.extend(additional_stop_words)
-
-    # Hold a list of terms 
-    identified_terms = []
-
-    for file in paper_list:
-
-        if verbose:
-            print("On paper...", file)
-        
-        with open(file, "r") as info:
-
-            # Read entire paper
-            content = info.read()
-
-            # Search for terms throughout paper
-            b13_apply = nlp_b13(text = content)
-            
-            # Extract terms and labels
-            b13_terms = []
-            b13_labels = []
-
-            # Unwrap bionlp13cg labels 
-            for ent in b13_apply.ents:
-                b13_terms.append(ent.text)
-                b13_labels.append(ent.label_)
-
-            # Create data.frame
-            res = pd.DataFrame({"term":b13_terms, "label":b13_labels})
-            terms = res[res["label"].isin(tags)]["term"].unique().tolist()
-
-            # Clean terms 
-            for term in terms:
-                term = re.sub("[^\s\d\w]|\n", '', term.lower().strip())
-                if len(term) >= min_length and len(term) <= max_length and term not in stop_words:
-                    identified_terms.append(term)
+    table = count_terms_scispacy(paper_directory, omes_folder, tags, additional_stop_words, min_length, max_length,
+                                 cache_directory, tokenizer, batch_size, n_process, chunk_size, chunk_overlap,
+                                 entity_cache_directory, verbose)
 
     # Return unique list
-    return list(set(identified_terms))
\ No newline at end of file
+    return table[table["document_frequency"] >= min_document_frequency]["term"].unique().tolist()
@@ -1,97 +1,610 @@
 import os
-import pandas as pd
-import nltk
 import re
+import json
+import hashlib
+import pandas as pd
+import multiprocessing
 from pathlib import Path
+from itertools import combinations
+
+from .term_matcher import TermMatcher, TermIndex
+from .sentence_cache import _read_paper_sentences, _TOKENIZERS
+from .cooccurrence import _CooccurrenceCounter
+
+# The matcher, scan settings, and required terms used by pool workers. They are set before the pool starts so
+# forked workers inherit them instead of receiving a pickled copy with every paper.
+_worker_state = None
+
+# Columns of the sentence_biomolecule_pairs table. Term offsets are character offsets in the cleaned segment.
+_COLUMN_NAMES = ['paper_id','term_1','term_2','id','sentence_index', 'segment_length','segment',
+                 'term_1_start', 'term_1_end', 'term_2_start', 'term_2_end']
+
+# Columns of the sentence_occurrences table written when sentences are deduplicated
+_OCCURRENCE_COLUMNS = ['sentence_hash', 'paper_id', 'sentence_index']
+
+# Segments are limited to ASCII alphanumerics and spaces
+_SEGMENT_PATTERN = re.compile(r'[^a-zA-Z0-9 ]')
+
+def __as_matcher(terms):
+    """
+    Return the TermMatcher for a list of terms, a TermIndex, or a TermMatcher.
+    """
+    if isinstance(terms, TermMatcher):
+        return terms
+    if isinstance(terms, TermIndex):
+        return terms.matcher
+    return TermMatcher(terms)
+
+def __map_term_ids(matcher: TermMatcher, synonyms: pd.DataFrame):
+    """
+    Map each term to the set of ontology IDs it is a synonym of. Terms are looked up the same way `map_synonyms`
+    formats them. Terms without an ID are left out.
+    """
+    if synonyms is None:
+        return None
+    table = synonyms[["Synonym", "ID"]].dropna().astype(str)
+    table = table[table["ID"] != ""]
+    synonym_ids = table.groupby("Synonym")["ID"].agg(frozenset).to_dict()
+    term_ids = {}
+    for term in matcher.terms:
+        ids = synonym_ids.get(re.sub(r'[^a-zA-Z0-9]', '', term))
+        if ids is not None:
+            term_ids[term] = ids
+    return term_ids
+
+def __list_papers(paper_directory: str):
+    """
+    List all txt files under a directory, sorted so results are always merged in the same order.
+    """
+    file_paths = []
+    for root, _, files in os.walk(paper_directory):
+        for file in files:
+            if file.endswith(".txt"):
+                file_paths.append(os.path.join(root, file))
+    return sorted(file_paths, key = lambda x: (Path(x).stem, x))
+
+def _set_worker_state(state: tuple):
+    """
+    Pool initializer that stores the matcher, scan settings, and required terms in each worker process.
+    """
+    global _worker_state
+    _worker_state = state
+
+def _scan_paper_in_worker(args: tuple):
+    """
+    Scan one paper inside a pool worker with the shared matcher.
+    """
+    file_path, use_required_terms = args
+    matcher, settings, required_terms = _worker_state
+    return __scan_paper(file_path, matcher, settings, required_terms if use_required_terms else None)
+
+def __scan_paper(file_path: str, matcher: TermMatcher, settings: dict, required_terms: set[str] = None,
+                 seen_sentences: set[str] = None):
+    """
+    Find all pairs of terms that share a sentence in one paper.
+
+    Parameters
+    ----------
+    file_path
+        Path to the paper in txt format.
+
+    matcher
+        A TermMatcher built from the terms to find.
+
+    settings
+        A dictionary with max_char_length, padding, cache_directory, tokenizer, term_ids (the set of ontology IDs
+        of each term, or None), deduplicate_sentences, and cooccurrence. See `find_terms_in_papers`.
+
+    required_terms
+        If not None, only pairs with at least one of these terms are returned.
+
+    seen_sentences
+        Hashes of sentences that already produced rows in earlier papers. These sentences are not matched again.
+        Only used when deduplicating sentences without counting co-occurrence.
+
+    Returns
+    -------
+        A list of rows, one per pair of terms per sentence, a list of (sentence_hash, paper_id, sentence_index)
+        occurrences of each sentence that produced rows or was skipped as already seen, and the sorted indices of the
+        terms found in each sentence. Occurrences are only recorded when deduplicating sentences, and term indices
+        only when counting co-occurrence.
+    """
 
-def find_terms_in_papers(paper_directory: str, terms: list[str], output_directory: str = None, 
-                         n_gram_max: int = 3, max_char_length: int = 250, padding: int = 10, 
-                         verbose: bool = False):   
+    max_char_length, padding, term_ids = settings["max_char_length"], settings["padding"], settings["term_ids"]
+    deduplicate, cooccurrence = settings["deduplicate_sentences"], settings["cooccurrence"]
+    file_id = Path(file_path).stem
+    rows, occurrences, sentence_terms = [], [], []
+    paper = _read_paper_sentences(file_path, settings["cache_directory"], settings["tokenizer"])
+
+    for sentence_ind, (sentence, token_spans) in enumerate(zip(paper["sentences"], paper["token_spans"])):
+
+        # Fingerprint the sentence, and skip it if it has been matched before
+        if deduplicate:
+            sentence_hash = hashlib.blake2b(sentence.encode("utf-8"), digest_size = 16).hexdigest()
+            if seen_sentences is not None and sentence_hash in seen_sentences:
+                occurrences.append([sentence_hash, file_id, sentence_ind])
+                continue
+            sentence_rows = len(rows)
+
+        # Keep the first position of each term in the sentence, and where that occurrence ends
+        first_index, first_end = {}, {}
+        matches = matcher.find(sentence, token_spans)
+        for start, end, term_index in matches:
+            term = matcher.terms[term_index]
+            if term not in first_index or start < first_index[term]:
+                first_index[term] = start
+                first_end[term] = end
+        if cooccurrence:
+            sentence_terms.append(sorted(set(term_index for _, _, term_index in matches)))
+        if len(first_index) < 2:
+            continue
+        if required_terms is not None and required_terms.isdisjoint(first_index):
+            continue
+
+        # ID pairs already written for this sentence. With synonyms, pairs are visited in order of position so the
+        # mentions that come first in the sentence are kept.
+        id_pairs = set()
+        if term_ids is None:
+            found_terms = sorted(first_index)
+        else:
+            found_terms = sorted(first_index, key = lambda term: (first_index[term], term))
+
+        for pair in combinations(found_terms, 2):
+            if required_terms is not None and pair[0] not in required_terms and pair[1] not in required_terms:
+                continue
+
+            # Skip synonyms of the same biomolecule, and pairs of biomolecules already in this sentence.
+            # Terms without an ID stand for themselves.
+            if term_ids is not None:
+                ids1, ids2 = term_ids.get(pair[0], pair[0]), term_ids.get(pair[1], pair[1])
+                if ids1 == ids2 and isinstance(ids1, frozenset) and len(ids1) == 1:
+                    continue
+                id_pair = frozenset([ids1, ids2])
+                if id_pair in id_pairs:
+                    continue
+
+            index1 = first_index[pair[0]]
+            index2 = first_index[pair[1]]
+
+            # Assign term based off of which occurs first in sentence
+            if index1 < index2:
+                term1 = pair[0]
+                term2 = pair[1]
+            else:
+                term1 = pair[1]
+                term2 = pair[0]
+
+            # Create segment of sentence with terms if len(sentence) is too long
+            if len(sentence) < max_char_length:
+                segment_start = 0
+                segment = sentence
+            else:
+                first, second = min(index1, index2), max(index1, index2)
+                segment_start = max(0, first-padding)
+                segment = sentence[segment_start:
+                                    min(len(sentence)-1, second + max(len(term1), len(term2)) +padding)]
+                if len(segment) > max_char_length:
+                    continue
+
+            # Clean up any nonalphanumerics
+            cleaned = _SEGMENT_PATTERN.sub('', segment)
+            row = [file_id, term1, term2, file_id, sentence_ind, len(segment), cleaned]
+
+            # Offsets of both terms in the cleaned segment, or -1 if the segment cuts a term off
+            for term in (term1, term2):
+                start, end = first_index[term] - segment_start, first_end[term] - segment_start
+                if end > len(segment):
+                    row.extend([-1, -1])
+                elif len(cleaned) == len(segment):
+                    row.extend([start, end])
+                else:
+                    row.extend([len(_SEGMENT_PATTERN.sub('', segment[:start])), len(_SEGMENT_PATTERN.sub('', segment[:end]))])
+            if deduplicate:
+                row.append(sentence_hash)
+            rows.append(row)
+            if term_ids is not None:
+                id_pairs.add(id_pair)
+
+        if deduplicate and len(rows) > sentence_rows:
+            occurrences.append([sentence_hash, file_id, sentence_ind])
+
+    return rows, occurrences, sentence_terms
+
+def __iter_paper_matches(paper_list: list[str], matcher: TermMatcher, settings: dict, n_workers: int, verbose: bool,
+                         required_terms: set[str] = None, required_papers: set[str] = None, seen_sentences: set[str] = None):
+    """
+    Scan papers in order, serially or with a process pool, and yield the rows, sentence occurrences, and sentence
+    terms of each paper as it finishes. Papers in required_papers only return pairs with at least one of the required_terms. When
+    scanning serially, sentences in seen_sentences are not matched again.
+    """
+
+    if required_papers is None:
+        required_papers = set()
+
+    if n_workers > 1 and len(paper_list) > 1:
+
+        # Forked workers inherit the state. Otherwise, it is pickled once per worker.
+        global _worker_state
+        state = (matcher, settings, required_terms)
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+            _worker_state = state
+            initializer, initargs = None, ()
+        else:
+            context = multiprocessing.get_context()
+            initializer, initargs = _set_worker_state, (state,)
+
+        try:
+            with context.Pool(n_workers, initializer = initializer, initargs = initargs) as pool:
+                # imap keeps the order of paper_list
+                tasks = [(file_path, file_path in required_papers) for file_path in paper_list]
+                for file_path, result in zip(paper_list, pool.imap(_scan_paper_in_worker, tasks, chunksize = 4)):
+                    if verbose:
+                        print("On file " + os.path.basename(file_path))
+                    yield result
+        finally:
+            _worker_state = None
+
+    else:
+        for file_path in paper_list:
+            if verbose:
+                print("On file " + os.path.basename(file_path))
+            yield __scan_paper(file_path, matcher, settings, required_terms if file_path in required_papers else None,
+                               seen_sentences)
+
+def __deduplicate_sentences(paper_matches, seen_sentences: set[str]):
+    """
+    Drop the rows of every sentence that already produced rows earlier in the corpus, keeping its occurrences so the
+    rows can be fanned out again with `expand_sentence_duplicates`. Sentence terms are passed through unchanged.
+    """
+    for rows, occurrences, sentence_terms in paper_matches:
+        duplicates = set()
+        for sentence_hash, _, sentence_index in occurrences:
+            if sentence_hash in seen_sentences:
+                duplicates.add(sentence_index)
+            else:
+                seen_sentences.add(sentence_hash)
+        if len(duplicates) > 0:
+            rows = [row for row in rows if row[4] not in duplicates]
+        yield rows, occurrences, sentence_terms
+
+def __count_cooccurrence(paper_matches, counter: _CooccurrenceCounter):
+    """
+    Add the sentence terms of each paper to the co-occurrence counts as the papers pass through.
+    """
+    for paper_match in paper_matches:
+        counter.add_paper(paper_match[2])
+        yield paper_match
+
+def __write_matches(output_path: str, paper_matches, chunk_size: int, columns: list[str] = _COLUMN_NAMES,
+                    occurrences_path: str = None):
+    """
+    Append the rows of each paper to a csv file, flushing whenever at least chunk_size rows are held in memory.
+    Sentence occurrences are appended to occurrences_path if given.
+    """
+    matches, occurrences = [], []
+    for paper_rows, paper_occurrences, _ in paper_matches:
+        matches.extend(paper_rows)
+        occurrences.extend(paper_occurrences)
+        if len(matches) + len(occurrences) >= chunk_size:
+            pd.DataFrame(matches, columns = columns).to_csv(output_path, mode = "a", header = False, index = False)
+            if occurrences_path is not None:
+                pd.DataFrame(occurrences, columns = _OCCURRENCE_COLUMNS).to_csv(occurrences_path, mode = "a", header = False, index = False)
+            matches, occurrences = [], []
+    if len(matches) > 0:
+        pd.DataFrame(matches, columns = columns).to_csv(output_path, mode = "a", header = False, index = False)
+    if occurrences_path is not None and len(occurrences) > 0:
+        pd.DataFrame(occurrences, columns = _OCCURRENCE_COLUMNS).to_csv(occurrences_path, mode = "a", header = False, index = False)
+
+def __paper_record(file_path: str, previous: dict = None):
+    """
+    Record the size, modification time, and content hash of a paper. The hash of the previous record is reused
+    if the size and modification time have not changed.
+    """
+    stat = os.stat(file_path)
+    if previous is not None and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+        content_hash = previous["sha256"]
+    else:
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        content_hash = sha.hexdigest()
+    return {"paper_id": Path(file_path).stem, "size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": content_hash}
+
+def iter_terms_in_papers(paper_directory: str, terms: list[str], max_char_length: int = 250, padding: int = 10,
+                         n_workers: int = 1, cache_directory: str = None, tokenizer: str = "nltk",
+                         synonyms: pd.DataFrame = None, verbose: bool = False):
+    """
+    A generator version of `find_terms_in_papers` that yields one match at a time, so the full table never has to be held in memory.
+    Matches are yielded in the same order as the rows of `find_terms_in_papers`.
+
+    Parameters
+    ----------
+    paper_directory
+        A directory path pointing to the list of papers to be parsed through.
+
+    terms
+        List of terms to find in papers, or a TermIndex or TermMatcher already built from them.
+
+    max_char_length
+        The number of maximum characters that can be in a segment containing the pair of biomolecules
+
+    padding
+        The amount of padding (in characters) to surround the terms in a segment by at minimum.
+
+    n_workers
+        Number of processes to scan papers with. Default is 1.
+
+    cache_directory
+        An optional path to a sentence cache. See `cache_sentences`.
+
+    tokenizer
+        The sentence splitter, either "nltk" or the faster "regex". See `sentence_spans`. Default is "nltk".
+
+    synonyms
+        An optional synonym table from `map_synonyms`. See `find_terms_in_papers`.
+
+    verbose
+        If True, print status messages
+
+    Returns
+    -------
+        A generator of dictionaries with the columns of the sentence_biomolecule_pairs table as keys.
+    """
+
+    matcher = __as_matcher(terms)
+    settings = {"max_char_length": max_char_length, "padding": padding, "cache_directory": cache_directory,
+                "tokenizer": tokenizer, "term_ids": __map_term_ids(matcher, synonyms), "deduplicate_sentences": False,
+                "cooccurrence": False}
+    if cache_directory is not None and os.path.exists(cache_directory) == False:
+        os.mkdir(cache_directory, mode = 0o777)
+    for rows, _, _ in __iter_paper_matches(__list_papers(paper_directory), matcher, settings, n_workers, verbose):
+        for row in rows:
+            yield dict(zip(_COLUMN_NAMES, row))
+
+def find_terms_in_papers(paper_directory: str, terms: list[str], output_directory: str = None,
+                         n_gram_max: int = 3, max_char_length: int = 250, padding: int = 10,
+                         n_workers: int = 1, chunk_size: int = 100000, incremental: bool = False,
+                         cache_directory: str = None, tokenizer: str = "nltk", synonyms: pd.DataFrame = None,
+                         deduplicate_sentences: bool = False, cooccurrence: bool = False, verbose: bool = False):
     """
     This function searches through sentences of papers to extract biomolecule pairs present in each sentence.
-    It utilizes a set-intersection method on the n-grams of the sentences with the already-found biomolecule synonyms.
+    Terms are compiled once into an Aho-Corasick automaton (see `TermMatcher` and `TermIndex`) which scans each sentence in a single pass.
 
     Parameters
     ----------
     paper_directory
         A directory path pointing to the list of papers to be parsed through.
-    
+
     terms
-        List of terms to find in papers
-    
+        List of terms to find in papers, or a TermIndex or TermMatcher already built from them.
+
     output_directory
         An optional path to a directory for where to write results to. Otherwise, the function will return the table.
 
     n_gram_max
-        The number of n_grams to consider when combing the papers. (e.g. n_grams=2 will catch "protein A" but n_grams=1 will not). If unsure, use the default.
-    
-    max_char_length 
+        No longer used. Terms of any number of words are matched. Kept for backwards compatibility.
+
+    max_char_length
         The number of maximum characters that can be in a segment containing the pair of biomolecules
-        
+
     padding
         The amount of padding (in characters) to surround the terms in a segment by at minimum.
-    
+
+    n_workers
+        Number of processes to scan papers with. Default is 1. The terms are compiled once and shared with the workers,
+        and results are always returned in the same order regardless of the number of workers.
+
+    chunk_size
+        When writing to output_directory, matches are appended to the file once at least this many rows are
+        held in memory. Default is 100000.
+
+    incremental
+        If True, keep a manifest of every paper (path, size, modification time, and content hash) and of the terms next to
+        the output, and on later runs only scan new or changed papers. Rows of changed and removed papers are dropped,
+        rows with removed terms are dropped, and unchanged papers are only scanned for pairs with newly added terms.
+        New rows are appended to the end of the existing table. Requires output_directory. Default is False.
+
+    cache_directory
+        An optional path to a sentence cache. Papers found in the cache are not split into sentences again, and
+        new papers are added to it. See `cache_sentences`.
+
+    tokenizer
+        The sentence splitter. "nltk" uses `nltk.sent_tokenize` (Punkt). "regex" uses a precompiled regular expression
+        that is several times faster, with slightly different sentence boundaries. See `sentence_spans`. Default is "nltk".
+
+    synonyms
+        An optional synonym table from `map_synonyms` (columns Synonym, ID, and Type). If provided, pairs of synonyms
+        of the same biomolecule are dropped, and only the first pair of each pair of IDs is kept per sentence (the
+        pair whose mentions come first in the sentence), so fewer rows reach `run_bert`. Terms without an ID are kept as they are. With incremental scans, pairs are
+        only collapsed among the rows scanned in the same run. Default is None.
+
+    deduplicate_sentences
+        If True, each distinct normalized sentence is matched only once across the corpus, so repeated text (methods
+        boilerplate, licenses, or a paper downloaded twice) does not produce repeated rows for `run_bert`. Rows gain a
+        sentence_hash column, and every (sentence_hash, paper_id, sentence_index) occurrence of the matched sentences
+        is written to "sentence_occurrences.csv". Use `expand_sentence_duplicates` to fan rows back out to every
+        occurrence. Requires output_directory, and cannot be used with incremental. Default is False.
+
+    cooccurrence
+        If True, also count how many sentences and papers each pair of terms appears in together, as a sparse
+        `CooccurrenceMatrix`. It is saved to output_directory as "term_cooccurrence_sentence.npz" and
+        "term_cooccurrence_paper.npz". Load it with `CooccurrenceMatrix.load` and score it with `score_cooccurrence`.
+        Every sentence is counted, so the counts are the same with deduplicate_sentences. Requires output_directory,
+        and cannot be used with incremental. Default is False.
+
     verbose
         If True, print status messages
-    
+
     Returns
     -------
-        A Pandas DataFrame of the resulting data.
+        A Pandas DataFrame of the resulting data. The term_1_start, term_1_end, term_2_start, and term_2_end columns
+        hold the character offsets of each term in the segment, which `run_bert` uses to place its markers, or -1
+        if the segment cuts the term off.
     """
-    
-    # Modify term matches
-    terms = [re.sub("[^\s\d\w]|\n", '', term.lower()) for term in terms]
 
-    matches = []
-    for root, _, files in os.walk(paper_directory):
-        for file in files:
-            if file.endswith(".txt") is False:
-                continue
-            if verbose:
-                print("On file " + file)
-            file_path = os.path.join(root, file)
-            file_id = Path(file_path).stem
-            with open(file_path, "r") as f:
-                sentences = [re.sub("[^\s\d\w]|\n", '', x.lower()) for x in nltk.sent_tokenize(f.read())]
-                for sentence_ind, sentence in enumerate(sentences):
-                    words = nltk.word_tokenize(sentence)
-                    joined_word_ngrams = [' '.join(x) for x in list(nltk.everygrams(words, 1, n_gram_max))]
-                    found_terms = list(set(joined_word_ngrams).intersection(terms))
-                    if len(found_terms) > 1:
-                        pairs = [(a,b) if a < b else (b,a) for idx, a in enumerate(found_terms) for b in found_terms[idx + 1:] if a != b]
-                        for pair in set(pairs): 
-                            try:
-                                index1 = re.search(rf"\b{pair[0]}\b", sentence).span()[0]
-                                index2 = re.search(rf"\b{pair[1]}\b", sentence).span()[0]
-                            except AttributeError:
-                                continue
-                            # Assign term based off of which occurs first in sentence
-                            if index1 < index2:
-                                term1 = pair[0]
-                                term2 = pair[1]
-                            else:
-                                term1 = pair[1]
-                                term2 = pair[0]
-                            # Create segment of sentence with terms if len(sentence) is too long
-                            if len(sentence) < max_char_length:
-                                segment = sentence
-                            else:
-                                first_index, second_index = min(index1, index2), max(index1, index2)
-                                segment = sentence[max(0, first_index-padding):
-                                                    min(len(sentence)-1, second_index + max(len(term1), len(term2)) +padding)]
-                                if len(segment) > max_char_length:
-                                    continue
-
-                            matches.append([file_id, term1, term2, '_'.join([file_id]), sentence_ind, len(segment), segment])
-                
-    # Wrap up matches and write to a CSV file       
-    column_names = ['paper_id','term_1','term_2','id','sentence_index', 'segment_length','segment']
-    matches_df = pd.DataFrame(matches, columns = column_names).sort_values('paper_id')
-
-    # Clean up any nonalphanumerics
-    matches_df["segment"] = matches_df["segment"].str.replace(r'[^a-zA-Z0-9 ]', '', regex=True)
-
-    if output_directory is not None:
-        matches_df.to_csv(os.path.join(output_directory, "sentence_biomolecule_pairs.csv"), index=False)
+    if incremental and output_directory is None:
+        raise Exception("An output_directory is required for incremental scans.")
+    if deduplicate_sentences and output_directory is None:
+        raise Exception("An output_directory is required to write the sentence occurrences of deduplicate_sentences.")
+    if cooccurrence and output_directory is None:
+        raise Exception("An output_directory is required to write the co-occurrence counts.")
+    if tokenizer not in _TOKENIZERS:
+        raise Exception("tokenizer must be one of: " + ", ".join(_TOKENIZERS))
+    if incremental and deduplicate_sentences:
+        raise Exception("incremental and deduplicate_sentences cannot be used together.")
+    if incremental and cooccurrence:
+        raise Exception("incremental and cooccurrence cannot be used together.")
+
+    # Compile terms once
+    matcher = __as_matcher(terms)
+    settings = {"max_char_length": max_char_length, "padding": padding, "cache_directory": cache_directory,
+                "tokenizer": tokenizer, "term_ids": __map_term_ids(matcher, synonyms),
+                "deduplicate_sentences": deduplicate_sentences, "cooccurrence": cooccurrence}
+    columns = _COLUMN_NAMES + ["sentence_hash"] if deduplicate_sentences else _COLUMN_NAMES
+    paper_list = __list_papers(paper_directory)
+    if cache_directory is not None and os.path.exists(cache_directory) == False:
+        os.mkdir(cache_directory, mode = 0o777)
+
+    # Settings that change the resulting table
+    manifest_settings = {"max_char_length": max_char_length, "padding": padding, "tokenizer": tokenizer,
+                         "synonyms_fingerprint": None, "columns": _COLUMN_NAMES}
+    if settings["term_ids"] is not None:
+        mapped = sorted(term + "\t" + ",".join(sorted(ids)) for term, ids in settings["term_ids"].items())
+        manifest_settings["synonyms_fingerprint"] = hashlib.sha256("\n".join(mapped).encode()).hexdigest()
+    terms = sorted(matcher.terms)
+    terms_fingerprint = hashlib.sha256("\n".join(terms).encode()).hexdigest()
+
+    # Papers are scanned in order of paper_id, so the first occurrence of each sentence keeps its rows. Co-occurrence
+    # is counted over every sentence, so repeated sentences are still matched when counting it.
+    seen_sentences = set() if deduplicate_sentences else None
+    paper_matches = __iter_paper_matches(paper_list, matcher, settings, n_workers, verbose,
+                                         seen_sentences = None if cooccurrence else seen_sentences)
+    if cooccurrence:
+        counter = _CooccurrenceCounter(len(matcher.terms))
+        paper_matches = __count_cooccurrence(paper_matches, counter)
+    if deduplicate_sentences:
+        paper_matches = __deduplicate_sentences(paper_matches, seen_sentences)
+
+    if output_directory is None:
+        matches = []
+        for paper_rows, _, _ in paper_matches:
+            matches.extend(paper_rows)
+        return(pd.DataFrame(matches, columns = columns))
+
+    output_path = os.path.join(output_directory, "sentence_biomolecule_pairs.csv")
+    manifest_path = os.path.join(output_directory, "sentence_biomolecule_pairs_manifest.json")
+
+    # Read the previous manifest. A change in settings requires a full scan.
+    manifest = None
+    if incremental and os.path.exists(manifest_path) and os.path.exists(output_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("settings") != manifest_settings:
+            manifest = None
+
+    if manifest is None:
+
+        # Write the header, then append matches in chunks as papers finish. Papers are scanned in order of paper_id.
+        pd.DataFrame(columns = columns).to_csv(output_path, index=False)
+        occurrences_path = None
+        if deduplicate_sentences:
+            occurrences_path = os.path.join(output_directory, "sentence_occurrences.csv")
+            pd.DataFrame(columns = _OCCURRENCE_COLUMNS).to_csv(occurrences_path, index=False)
+        __write_matches(output_path, paper_matches, chunk_size, columns, occurrences_path)
+        if cooccurrence:
+            counter.result(matcher.terms).save(output_directory)
+        previous_papers, records = {}, {}
+
     else:
-        return(matches_df)
\ No newline at end of file
+
+        # Compare papers to the manifest
+        previous_papers = manifest["papers"]
+        current = {Path(os.path.relpath(x, paper_directory)).as_posix(): x for x in paper_list}
+        stale_ids, new_papers, records = set(), set(), {}
+        for relative_path, previous in previous_papers.items():
+            if relative_path not in current:
+                stale_ids.add(previous["paper_id"])
+                continue
+            records[relative_path] = __paper_record(current[relative_path], previous)
+            if records[relative_path]["sha256"] != previous["sha256"]:
+                stale_ids.add(previous["paper_id"])
+        for relative_path, file_path in current.items():
+            if relative_path not in previous_papers:
+                new_papers.add(file_path)
+
+        # Compare terms to the manifest
+        if manifest["terms_fingerprint"] == terms_fingerprint:
+            added_terms, removed_terms = set(), set()
+        else:
+            previous_terms = set(manifest["terms"])
+            added_terms = set(terms).difference(previous_terms)
+            removed_terms = previous_terms.difference(terms)
+
+        # Papers sharing a paper_id with a stale paper are rescanned in full, since rows are identified by paper_id.
+        # Every other paper is only scanned for pairs with added terms.
+        rescan = [x for x in paper_list if x in new_papers or Path(x).stem in stale_ids]
+        if len(added_terms) > 0:
+            required_papers = set(paper_list).difference(rescan)
+            rescan = paper_list
+        else:
+            required_papers = set()
+
+        if verbose:
+            print(str(len(new_papers)) + " new papers, " + str(len(stale_ids)) + " changed or removed papers, " +
+                  str(len(added_terms)) + " added terms, and " + str(len(removed_terms)) + " removed terms")
+
+        if len(rescan) > 0 or len(stale_ids) > 0 or len(removed_terms) > 0:
+
+            # Copy over rows that are still valid, then append the new rows
+            temp_path = output_path + ".tmp"
+            pd.DataFrame(columns = _COLUMN_NAMES).to_csv(temp_path, index=False)
+            for chunk in pd.read_csv(output_path, chunksize = chunk_size, dtype = str, keep_default_na = False):
+                keep = ~chunk["paper_id"].isin(stale_ids) & ~chunk["term_1"].isin(removed_terms) & ~chunk["term_2"].isin(removed_terms)
+                chunk[keep].to_csv(temp_path, mode = "a", header = False, index = False)
+            __write_matches(temp_path, __iter_paper_matches(rescan, matcher, settings, n_workers, verbose,
+                                                            added_terms, required_papers), chunk_size)
+            os.replace(temp_path, output_path)
+
+    if incremental:
+        papers = {}
+        for file_path in paper_list:
+            relative_path = Path(os.path.relpath(file_path, paper_directory)).as_posix()
+            if relative_path in records:
+                papers[relative_path] = records[relative_path]
+            else:
+                papers[relative_path] = __paper_record(file_path, previous_papers.get(relative_path))
+        with open(manifest_path, "w") as f:
+            json.dump({
+                "settings": manifest_settings,
+                "terms_fingerprint": terms_fingerprint,
+                "terms": terms,
+                "papers": papers
+            }, f)
+    elif os.path.exists(manifest_path):
+        # A full rewrite makes any previous manifest stale
+        os.remove(manifest_path)
+
+def expand_sentence_duplicates(table: pd.DataFrame, occurrences: pd.DataFrame):
+    """
+    Fan the rows of a table made with `find_terms_in_papers(deduplicate_sentences = True)`, or the `run_bert`
+    results of that table, back out to every paper and sentence the sentence occurs in.
+
+    Parameters
+    ----------
+    table
+        A table with sentence_hash, paper_id, id, and sentence_index columns.
+
+    occurrences
+        The sentence occurrences table ("sentence_occurrences.csv").
+
+    Returns
+    -------
+        A Pandas DataFrame with one row per row of the table per occurrence of its sentence.
+    """
+    table = table.assign(sentence_hash = table["sentence_hash"].astype(str))
+    occurrences = occurrences.assign(sentence_hash = occurrences["sentence_hash"].astype(str))
+    expanded = table.drop(columns = ["paper_id", "id", "sentence_index"]).merge(occurrences, on = "sentence_hash")
+    expanded["id"] = expanded["paper_id"]
+    return expanded[table.columns]
@@ -0,0 +1,248 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+
+from .bert_functions import _marked_sentences
+
+# The text before the first term, between the terms, and after the second term of a marked sentence
+_MARKED_PATTERN = r"^(?P<left>.*?)@TERM\$[12](?P<between>.*?)@TERM\$[12](?P<right>.*)$"
+
+# Buckets of the number of words between the terms: 0, 1, 2-3, 4-7, and so on
+_DISTANCE_BUCKETS = 8
+
+# Name of a saved prefilter within its directory
+_PREFILTER_FILENAME = "pair_prefilter.npz"
+
+class PairPrefilter:
+    """
+    A fast linear classifier that skips pairs that are very unlikely to be relationships before they are sent to
+    BERT. Pairs are described by hashed word and word-pair features of the text before, between, and after the two
+    terms, and the number of words between them. Fit it to the results of `run_bert` on a sample of pairs, then
+    pass it to `run_bert` to score only the pairs above its threshold. Check how many relationships are lost with
+    `prefilter_recall`.
+
+    Parameters
+    ----------
+    n_features
+        The number of hashed features of each part of the sentence. Default is 2 ** 18.
+
+    context_words
+        The number of words before the first term and after the second term to use. Default is 5.
+    """
+    def __init__(self, n_features: int = 2 ** 18, context_words: int = 5):
+        self.n_features = n_features
+        self.context_words = context_words
+        self.coef = None
+        self.intercept = 0.0
+        self.threshold = 0.0
+
+    def _features(self, sentences: pd.Series):
+        parts = sentences.astype(str).str.extract(_MARKED_PATTERN).fillna("")
+        left = parts["left"].str.split().str[-self.context_words:].str.join(" ")
+        right = parts["right"].str.split().str[:self.context_words].str.join(" ")
+        between = parts["between"]
+
+        vectorizer = HashingVectorizer(n_features = self.n_features, ngram_range = (1, 2), alternate_sign = False)
+        distance = np.minimum(np.log2(between.str.split().str.len().to_numpy() + 1).astype(int), _DISTANCE_BUCKETS - 1)
+        distance = sparse.csr_matrix((np.ones(len(sentences)), (np.arange(len(sentences)), distance)), shape = (len(sentences), _DISTANCE_BUCKETS))
+        return sparse.hstack([vectorizer.transform(left), vectorizer.transform(between), vectorizer.transform(right), distance], format = "csr")
+
+    def _sentences(self, table: pd.DataFrame, segment_col_name: str):
+        # Results of run_bert have the marked sentence. Otherwise, mark the terms as run_bert would.
+        if "Sentence" in table.columns:
+            return table["Sentence"]
+        return _marked_sentences(table, segment_col_name)
+
+    def fit(self, results: pd.DataFrame, target_recall: float = 0.99, label_threshold: float = 0.5,
+            validation_fraction: float = 0.2, C: float = 1.0, random_state: int = 0):
+        """
+        Fit the classifier to the results of `run_bert`, and set the threshold that keeps target_recall of the
+        relationships in a held-out part of the results.
+
+        Parameters
+        ----------
+        results
+            The results of `run_bert` (bert_results.txt) on a sample of pairs
+
+        target_recall
+            The fraction of relationships the threshold should keep. Default is 0.99.
+
+        label_threshold
+            Pairs with a "True Positive" probability at or above this are relationships. Default is 0.5.
+
+        validation_fraction
+            The fraction of results held out to set the threshold. Default is 0.2.
+
+        C
+            The inverse of the regularization strength of the logistic regression. Default is 1.
+
+        random_state
+            The seed of the held-out split. Default is 0.
+
+        Returns
+        -------
+            The PairPrefilter
+        """
+
+        labels = (results["True Positive"] >= label_threshold).to_numpy()
+        if labels.all() or labels.any() == False:
+            raise Exception("results must contain both relationships and pairs that are not relationships")
+
+        features = self._features(results["Sentence"])
+        holdout = np.random.default_rng(random_state).random(len(results)) < validation_fraction
+        if labels[~holdout].all() or labels[~holdout].any() == False:
+            holdout[:] = False
+
+        model = LogisticRegression(C = C, solver = "liblinear", class_weight = "balanced")
+        model.fit(features[~holdout], labels[~holdout])
+        self.coef = model.coef_.ravel().astype(np.float32)
+        self.intercept = float(model.intercept_[0])
+
+        # The highest threshold that keeps target_recall of the held-out relationships
+        positives = holdout & labels if (holdout & labels).any() else labels
+        self.threshold = float(np.quantile(self._scores(features[positives]), 1 - target_recall, method = "lower"))
+        return self
+
+    def _scores(self, features: sparse.csr_matrix):
+        return 1 / (1 + np.exp(-(features @ self.coef + self.intercept)))
+
+    def score(self, table: pd.DataFrame, segment_col_name: str = "segment"):
+        """
+        Score each pair of a table from `find_terms_in_papers` or `run_bert`.
+
+        Parameters
+        ----------
+        table
+            A table of sentence segments with term_1 and term_2 columns, or results of `run_bert`
+
+        segment_col_name
+            The name of the column representing the chunk of text containing the pair of biomolecules. Default is "segment".
+
+        Returns
+        -------
+            A numpy array with the estimated probability that each pair is a relationship. Rows that BERT cannot
+            score are NaN.
+        """
+        if self.coef is None:
+            raise Exception("The prefilter must be fit first")
+        sentences = self._sentences(table, segment_col_name)
+        scores = np.full(len(table), np.nan)
+        present = sentences.notna().to_numpy()
+        if present.any():
+            scores[present] = self._scores(self._features(sentences[present]))
+        return scores
+
+    def filter(self, table: pd.DataFrame, segment_col_name: str = "segment", threshold: float = None):
+        """
+        Keep the pairs of a table scored at or above the threshold. Rows that BERT cannot score are kept, and
+        dropped by BERT as usual.
+
+        Parameters
+        ----------
+        table
+            A table of sentence segments with term_1 and term_2 columns
+
+        segment_col_name
+            The name of the column representing the chunk of text containing the pair of biomolecules. Default is "segment".
+
+        threshold
+            Default is None, which uses the threshold set by `fit`.
+
+        Returns
+        -------
+            The rows of the table to send to BERT
+        """
+        scores = self.score(table, segment_col_name)
+        threshold = self.threshold if threshold is None else threshold
+        return table[np.isnan(scores) | (scores >= threshold)]
+
+    def _fingerprint(self):
+        # A hash of everything but the threshold, which may be overridden when the prefilter is used
+        digest = hashlib.sha256(np.ascontiguousarray(self.coef, dtype = np.float32).tobytes())
+        digest.update(str((self.intercept, self.n_features, self.context_words)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def save(self, directory: str):
+        """
+        Write the prefilter to a directory as "pair_prefilter.npz".
+
+        Parameters
+        ----------
+        directory
+            Path to the directory to write to. It is created if it does not exist.
+        """
+        if self.coef is None:
+            raise Exception("The prefilter must be fit first")
+        if os.path.exists(directory) == False:
+            os.mkdir(directory, mode = 0o777)
+        np.savez_compressed(os.path.join(directory, _PREFILTER_FILENAME), coef = self.coef, intercept = np.array(self.intercept),
+                            threshold = np.array(self.threshold), n_features = np.array(self.n_features),
+                            context_words = np.array(self.context_words))
+
+    @classmethod
+    def load(cls, directory: str):
+        """
+        Load a prefilter written by `save`.
+
+        Parameters
+        ----------
+        directory
+            Path to the directory the prefilter was saved to.
+
+        Returns
+        -------
+            A PairPrefilter
+        """
+        with np.load(os.path.join(directory, _PREFILTER_FILENAME)) as loaded:
+            prefilter = cls(int(loaded["n_features"]), int(loaded["context_words"]))
+            prefilter.coef = loaded["coef"]
+            prefilter.intercept = float(loaded["intercept"])
+            prefilter.threshold = float(loaded["threshold"])
+        return prefilter
+
+def prefilter_recall(prefilter: PairPrefilter, results: pd.DataFrame, label_threshold: float = 0.5, thresholds: list[float] = None):
+    """
+    Report how many relationships a prefilter keeps, and how many pairs it skips, at a range of thresholds. Use
+    results of `run_bert` that the prefilter was not fit to. Rows that BERT cannot score are not counted.
+
+    Parameters
+    ----------
+    prefilter
+        A fit PairPrefilter
+
+    results
+        The results of `run_bert` (bert_results.txt) on a sample of pairs, or any table of pairs with a "True Positive" column
+
+    label_threshold
+        Pairs with a "True Positive" probability at or above this are relationships. Default is 0.5.
+
+    thresholds
+        The prefilter thresholds to report. Default is None, which uses every percentile of the prefilter's scores
+        and the prefilter's own threshold.
+
+    Returns
+    -------
+        A Pandas DataFrame with the threshold, the recall (fraction of relationships kept), and the fraction of
+        pairs skipped at each threshold, from lowest to highest threshold
+    """
+
+    scores = prefilter.score(results)
+    labels = (results["True Positive"] >= label_threshold).to_numpy()
+    scored = np.isnan(scores) == False
+    scores, labels = scores[scored], labels[scored]
+    if thresholds is None:
+        thresholds = np.append(np.quantile(scores, np.linspace(0, 0.99, 100)), prefilter.threshold)
+    thresholds = np.unique(np.asarray(thresholds, dtype = float))
+
+    # Count the scores below each threshold
+    all_scores = np.sort(scores)
+    positive_scores = np.sort(scores[labels])
+    return pd.DataFrame({
+        "threshold": thresholds,
+        "recall": 1 - np.searchsorted(positive_scores, thresholds, side = "left") / max(len(positive_scores), 1),
+        "fraction_skipped": np.searchsorted(all_scores, thresholds, side = "left") / max(len(all_scores), 1)
+    })
@@ -0,0 +1,213 @@
+import os
+import re
+import hashlib
+import numpy as np
+import nltk
+
+from .term_matcher import _normalize_text, _TOKEN_PATTERN
+
+# Candidate sentence ends: terminal punctuation and any closing quotes or brackets, followed by whitespace and then
+# a capital letter or digit, which may be preceded by opening quotes, brackets, or footnote asterisks
+_SENTENCE_END_PATTERN = re.compile(r"[.!?]+[\"'”’)\]]*(?=\s+[\"'“‘(\[*]*[A-Z0-9])")
+
+# Words that are followed by a period without ending a sentence
+_ABBREVIATIONS = frozenset([
+    "al", "approx", "ca", "cf", "dr", "e.g", "eq", "eqs", "et", "fig", "figs", "i.e", "inc", "ltd", "mr", "mrs", "ms",
+    "no", "nos", "prof", "ref", "refs", "resp", "sp", "spp", "st", "suppl", "tab", "var", "viz", "vol", "vs"
+])
+
+# Supported sentence splitters
+_TOKENIZERS = ["nltk", "regex"]
+
+def __regex_sentence_spans(text: str):
+    '''
+    Split text into sentences with a single precompiled regular expression, skipping periods after common
+    abbreviations and single capital letters (initials, or genus names like "C. elegans").
+    '''
+    spans = []
+    start = 0
+    for match in _SENTENCE_END_PATTERN.finditer(text):
+        if text[match.start()] == ".":
+            preceding = text[max(start, match.start() - 20):match.start()].split()
+            word = preceding[-1].lstrip("([").lower() if len(preceding) > 0 else ""
+            if word in _ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+                continue
+        spans.append((start, match.end()))
+        start = match.end()
+    spans.append((start, len(text)))
+
+    # Remove surrounding whitespace and empty sentences
+    stripped = []
+    for start, end in spans:
+        sentence = text[start:end]
+        left = len(sentence) - len(sentence.lstrip())
+        right = len(sentence.rstrip())
+        if right > left:
+            stripped.append((start + left, start + right))
+    return stripped
+
+def sentence_spans(text: str, tokenizer: str = "nltk"):
+    '''
+    Split text into sentences.
+
+    Parameters
+    ----------
+    text
+        The text to split
+
+    tokenizer
+        Either "nltk" to use `nltk.sent_tokenize` (Punkt), or "regex" for a precompiled regular expression splitter
+        that is several times faster, at the cost of slightly different sentence boundaries. Default is "nltk".
+
+    Returns
+    -------
+        A list of (start, end) character offsets of each sentence in the text
+    '''
+
+    if tokenizer == "regex":
+        return __regex_sentence_spans(text)
+    elif tokenizer != "nltk":
+        raise Exception("tokenizer must be one of: " + ", ".join(_TOKENIZERS))
+
+    # Sentences are slices of the text, so find where each one starts
+    spans = []
+    position = 0
+    for sentence in nltk.sent_tokenize(text):
+        start = text.find(sentence, position)
+        if start < 0:
+            start = position
+        position = start + len(sentence)
+        spans.append((start, position))
+    return spans
+
+def __segment_paper(content: str, tokenizer: str):
+    '''
+    Split a paper into sentences, then normalize each sentence and find the character offsets of its words.
+
+    Parameters
+    ----------
+    content
+        The full text of the paper
+
+    tokenizer
+        The sentence splitter to use. See `sentence_spans`.
+
+    Returns
+    -------
+        A dictionary of numpy arrays: the normalized sentences as utf-8 bytes joined by newlines, the (start, end) of
+        each sentence in the original text, the (start, end) of each word within its normalized sentence, and the
+        index of the first word of each sentence.
+    '''
+
+    sentences, token_spans, token_offsets = [], [], [0]
+    raw_spans = sentence_spans(content, tokenizer)
+    for start, end in raw_spans:
+        sentence = _normalize_text(content[start:end])
+        sentences.append(sentence)
+        token_spans.extend(match.span() for match in _TOKEN_PATTERN.finditer(sentence))
+        token_offsets.append(len(token_spans))
+
+    # Normalized sentences never contain newlines, so they are safe to join on them
+    return {
+        "text": np.frombuffer("\n".join(sentences).encode("utf-8"), dtype = np.uint8),
+        "raw_spans": np.array(raw_spans, dtype = np.int64).reshape(-1, 2),
+        "token_spans": np.array(token_spans, dtype = np.int32).reshape(-1, 2),
+        "token_offsets": np.array(token_offsets, dtype = np.int64)
+    }
+
+def _read_paper_sentences(file_path: str, cache_directory: str = None, tokenizer: str = "nltk"):
+    '''
+    Read a paper and its sentences. If a cache directory is given, sentences are read from the cache when the paper
+    has been segmented before, and otherwise segmented and written to the cache. Entries are keyed by the
+    sha256 hash of the paper's content and the tokenizer.
+
+    Parameters
+    ----------
+    file_path
+        Path to the paper in txt format
+
+    cache_directory
+        Optional path to the sentence cache
+
+    tokenizer
+        The sentence splitter to use. See `sentence_spans`.
+
+    Returns
+    -------
+        A dictionary with the paper's "content", its normalized "sentences", the "raw_spans" (start, end) of each
+        sentence in the content, and the "token_spans" of the words in each normalized sentence.
+    '''
+
+    with open(file_path, "r") as f:
+        content = f.read()
+
+    segmented = None
+    if cache_directory is not None:
+        cache_path = os.path.join(cache_directory, hashlib.sha256(content.encode("utf-8")).hexdigest() + "_" + tokenizer + ".npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                segmented = {key: cached[key] for key in cached.files}
+        else:
+            segmented = __segment_paper(content, tokenizer)
+
+            # Write to a temporary file first so parallel scans never read a partial file
+            temp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+            with open(temp_path, "wb") as f:
+                np.savez_compressed(f, **segmented)
+            os.replace(temp_path, cache_path)
+    else:
+        segmented = __segment_paper(content, tokenizer)
+
+    # Unpack the arrays
+    raw_spans = [tuple(x) for x in segmented["raw_spans"].tolist()]
+    sentences = segmented["text"].tobytes().decode("utf-8").split("\n") if len(raw_spans) > 0 else []
+    token_spans = [tuple(x) for x in segmented["token_spans"].tolist()]
+    token_offsets = segmented["token_offsets"].tolist()
+
+    return {
+        "content": content,
+        "sentences": sentences,
+        "raw_spans": raw_spans,
+        "token_spans": [token_spans[token_offsets[x]:token_offsets[x + 1]] for x in range(len(sentences))]
+    }
+
+def cache_sentences(paper_directory: str, cache_directory: str, tokenizer: str = "nltk", verbose: bool = False):
+    '''
+    Split every paper into sentences once and store the sentence boundaries, normalized sentences, and word offsets
+    in a cache directory, with one compressed numpy file per paper keyed by the hash of its content. Pass the
+    same cache_directory to `find_terms_in_papers` and `extract_terms_scispacy` to skip sentence splitting. Papers
+    that are already in the cache are skipped.
+
+    Parameters
+    ----------
+    paper_directory
+        Directory of papers in txt format. Subdirectories are searched.
+
+    cache_directory
+        Directory to write the cache to. It is created if it does not exist.
+
+    tokenizer
+        The sentence splitter to use, either "nltk" or "regex". See `sentence_spans`. Default is "nltk".
+
+    verbose
+        If True, print status messages
+
+    Returns
+    -------
+        The number of papers read
+    '''
+
+    if os.path.exists(cache_directory) == False:
+        os.mkdir(cache_directory, mode = 0o777)
+
+    count = 0
+    for root, _, files in os.walk(paper_directory):
+        for file in sorted(files):
+            if file.endswith(".txt") is False:
+                continue
+            if verbose:
+                print("On file " + file)
+            _read_paper_sentences(os.path.join(root, file), cache_directory, tokenizer)
+            count += 1
+
+    return count
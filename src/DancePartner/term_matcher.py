@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import numpy as np
+from collections import deque
+from itertools import chain
+
+from .create_synonym_table import list_synonyms
+
+# Tokens of a normalized sentence are whitespace-delimited
+_TOKEN_PATTERN = re.compile(r"\S+")
+
+# Arrays written by TermIndex.save
+_INDEX_ARRAYS = ["terms", "term_lengths", "vocabulary", "vocabulary_size", "goto_offsets", "goto_tokens", "goto_states", "output", "fail", "dict_link"]
+
+# Everything that is not a letter, digit, underscore, or whitespace is stripped
+_NORMALIZE_PATTERN = re.compile(r"[^\s\d\w]|\n")
+
+def _normalize_text(text: str):
+    '''
+    Lowercase a string and remove all characters that are not letters, digits, underscores, or whitespace.
+    Both terms and sentences are normalized this way before matching.
+    '''
+    return _NORMALIZE_PATTERN.sub('', text.lower())
+
+def _join_strings(strings: list[str]):
+    '''
+    Store a list of strings without newlines as one utf-8 byte array.
+    '''
+    return np.frombuffer("\n".join(strings).encode("utf-8"), dtype = np.uint8)
+
+def _split_strings(data: np.ndarray, count: int):
+    '''
+    Recover a list of count strings stored with _join_strings.
+    '''
+    return data.tobytes().decode("utf-8").split("\n") if count > 0 else []
+
+class _MappedTransitions:
+    """
+    The transitions of each state of an automaton loaded with `TermIndex.load`, read from the memory-mapped arrays
+    the first time a sentence reaches the state, so only the states that are used are ever read into memory
+    """
+    def __init__(self, offsets: np.ndarray, tokens: np.ndarray, states: np.ndarray):
+        self.offsets = offsets
+        self.tokens = tokens
+        self.states = states
+        self.read = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, state: int):
+        transitions = self.read.get(state)
+        if transitions is None:
+            start, end = int(self.offsets[state]), int(self.offsets[state + 1])
+            transitions = dict(zip(self.tokens[start:end].tolist(), self.states[start:end].tolist()))
+            self.read[state] = transitions
+        return transitions
+
+    def __iter__(self):
+        return (self[state] for state in range(len(self)))
+
+class TermMatcher:
+    """
+    Aho-Corasick automaton that finds every occurrence of a list of terms in a normalized sentence in a single pass.
+    The automaton runs over whole words, so terms only match on word boundaries, and there is no limit on the
+    number of words in a term. Build it once and reuse it for every sentence.
+
+    Parameters
+    ----------
+    terms
+        List of terms to find. Terms are normalized (lowercased, non-alphanumerics removed) and deduplicated.
+    """
+    def __init__(self, terms: list[str]):
+
+        # Unique normalized terms and the number of words in each
+        self.terms = []
+        self.term_lengths = []
+
+        # Map each word to an integer, and hold the trie as a list of {word: state} transitions
+        self._vocabulary = {}
+        self._goto = [{}]
+        self._output = [-1]
+        term_lookup = {}
+
+        # Add each term to the trie
+        for term in terms:
+            tokens = _normalize_text(str(term)).split()
+            if len(tokens) == 0:
+                continue
+            key = " ".join(tokens)
+            if key in term_lookup:
+                continue
+            term_lookup[key] = len(self.terms)
+            self.terms.append(key)
+            self.term_lengths.append(len(tokens))
+
+            state = 0
+            for token in tokens:
+                token_id = self._vocabulary.setdefault(token, len(self._vocabulary))
+                next_state = self._goto[state].get(token_id)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._output.append(-1)
+                    self._goto[state][token_id] = next_state
+                state = next_state
+            self._output[state] = term_lookup[key]
+
+        # Build failure links and dictionary links (the nearest suffix state that completes a term) breadth-first
+        self._fail = [0] * len(self._goto)
+        self._dict_link = [-1] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token_id, child in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and token_id not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(token_id, 0)
+                self._fail[child] = fail
+                self._dict_link[child] = fail if self._output[fail] >= 0 else self._dict_link[fail]
+                queue.append(child)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _to_arrays(self):
+        """
+        Flatten the automaton into numpy arrays. Transitions are stored like a sparse matrix, with the words
+        and next states of each state held between goto_offsets[state] and goto_offsets[state + 1].
+        """
+        words = sorted(self._vocabulary, key = self._vocabulary.get)
+        goto_offsets = np.zeros(len(self._goto) + 1, dtype = np.int64)
+        goto_offsets[1:] = np.cumsum([len(x) for x in self._goto])
+        return {
+            "terms": _join_strings(self.terms),
+            "term_lengths": np.array(self.term_lengths, dtype = np.int32),
+            "vocabulary": _join_strings(words),
+            "vocabulary_size": np.array(len(words), dtype = np.int64),
+            "goto_offsets": goto_offsets,
+            "goto_tokens": np.fromiter(chain.from_iterable(self._goto), dtype = np.int32, count = goto_offsets[-1]),
+            "goto_states": np.fromiter(chain.from_iterable(x.values() for x in self._goto), dtype = np.int32, count = goto_offsets[-1]),
+            "output": np.array(self._output, dtype = np.int32),
+            "fail": np.array(self._fail, dtype = np.int32),
+            "dict_link": np.array(self._dict_link, dtype = np.int32)
+        }
+
+    @classmethod
+    def _from_arrays(cls, arrays: dict):
+        """
+        Rebuild an automaton from the arrays of `_to_arrays` without recompiling the terms. The transitions, the
+        largest part of the automaton, are left in the arrays and read as they are needed.
+        """
+        matcher = cls.__new__(cls)
+        matcher.term_lengths = arrays["term_lengths"].tolist()
+        matcher.terms = _split_strings(arrays["terms"], len(matcher.term_lengths))
+        words = _split_strings(arrays["vocabulary"], int(arrays["vocabulary_size"]))
+        matcher._vocabulary = dict(zip(words, range(len(words))))
+        matcher._goto = _MappedTransitions(arrays["goto_offsets"], arrays["goto_tokens"], arrays["goto_states"])
+        matcher._output = arrays["output"].tolist()
+        matcher._fail = arrays["fail"].tolist()
+        matcher._dict_link = arrays["dict_link"].tolist()
+        return matcher
+
+    def find(self, sentence: str, token_spans: list[tuple[int, int]] = None):
+        """
+        Find all terms in a normalized sentence, including overlapping matches.
+
+        Parameters
+        ----------
+        sentence
+            A sentence normalized the same way as the terms.
+
+        token_spans
+            Optional (start, end) character offsets of each word in the sentence. If None, words are split on whitespace.
+
+        Returns
+        -------
+            A list of (start, end, term_index) tuples, where start and end are character offsets in the sentence and
+            term_index is the position of the term in `terms`
+        """
+
+        if token_spans is None:
+            token_spans = [match.span() for match in _TOKEN_PATTERN.finditer(sentence)]
+
+        matches = []
+        state = 0
+        for position, (start, end) in enumerate(token_spans):
+
+            # Words that are in no term send the automaton back to the root
+            token_id = self._vocabulary.get(sentence[start:end])
+            if token_id is None:
+                state = 0
+                continue
+
+            while state and token_id not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(token_id, 0)
+
+            # Report every term ending at this word
+            hit = state if self._output[state] >= 0 else self._dict_link[state]
+            while hit > 0:
+                term_index = self._output[hit]
+                matches.append((token_spans[position - self.term_lengths[term_index] + 1][0], end, term_index))
+                hit = self._dict_link[hit]
+
+        return matches
+
+class TermIndex:
+    """
+    A reusable, compiled index of terms holding the normalized terms, a mapping of each term to its position in the
+    terms (term_positions), and the TermMatcher that finds them. Building the index from the omes folder is slow, so build it once per omes
+    release, `save` it, and `load` it afterwards. Pass it directly to `find_terms_in_papers` as the terms.
+
+    Parameters
+    ----------
+    terms
+        List of terms to index, such as the output of `list_synonyms`.
+    """
+    def __init__(self, terms: list[str]):
+        self.matcher = TermMatcher(terms)
+        self.terms = self.matcher.terms
+        self.term_positions = {term: index for index, term in enumerate(self.terms)}
+
+    @classmethod
+    def from_omes(cls, omes_folder: str, proteome_filename: str, min_length: int = 3):
+        """
+        Build a TermIndex from every synonym in the omes folder. See `list_synonyms`.
+
+        Parameters
+        ----------
+        omes_folder
+            Path to the omes folder. Required.
+
+        proteome_filename
+            Name of the proteome file within the omes folder. Use the full file name. Required.
+
+        min_length
+            Minimum number of characters in a term. Default is 3.
+
+        Returns
+        -------
+            A TermIndex
+        """
+        return cls(list_synonyms(omes_folder, proteome_filename, min_length))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term: str):
+        return " ".join(_normalize_text(str(term)).split()) in self.term_positions
+
+    def save(self, directory: str):
+        """
+        Write the index to a directory as one numpy array per file.
+
+        Parameters
+        ----------
+        directory
+            Path to the directory to write to. It is created if it does not exist.
+        """
+        if os.path.exists(directory) == False:
+            os.mkdir(directory, mode = 0o777)
+        for name, array in self.matcher._to_arrays().items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+        with open(os.path.join(directory, "term_index.json"), "w") as f:
+            json.dump({"version": 2, "n_terms": len(self.terms)}, f)
+
+    @classmethod
+    def load(cls, directory: str):
+        """
+        Load an index written by `save`. The terms are not normalized or compiled again, and the transitions of the
+        automaton stay memory-mapped, with each state's transitions read the first time a sentence reaches it.
+
+        Parameters
+        ----------
+        directory
+            Path to the directory the index was saved to.
+
+        Returns
+        -------
+            A TermIndex
+        """
+        with open(os.path.join(directory, "term_index.json"), "r") as f:
+            info = json.load(f)
+        if info.get("version") != 2:
+            raise Exception("The term index in " + directory + " was written by another version. Save it again.")
+        arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode = "r") for name in _INDEX_ARRAYS}
+
+        index = cls.__new__(cls)
+        index.matcher = TermMatcher._from_arrays(arrays)
+        index.terms = index.matcher.terms
+        if len(index.terms) != info["n_terms"]:
+            raise Exception("The term index in " + directory + " is incomplete. Save it again.")
+        index.term_positions = {term: position for position, term in enumerate(index.terms)}
+        return index
@@ -0,0 +1,95 @@
+import os
+import re
+import shutil
+from types import SimpleNamespace
+import DancePartner as dance
+from DancePartner import extract_terms
+from DancePartner.sentence_cache import sentence_spans
+
+## How to calculate coverage (from within main package directory):
+# coverage run --source=DancePartner -m pytest -x tests/* -W ignore
+# coverage report
+# coverage html
+
+# A stand-in for a spaCy model that finds every occurrence of a few names in each text
+class PatternNER:
+
+    def __init__(self, pattern: str):
+        self.pattern = re.compile(pattern)
+
+    def pipe(self, texts, as_tuples = True, batch_size = 32, n_process = 1):
+        for text, context in texts:
+            ents = [SimpleNamespace(text = match.group(), label_ = "GENE_OR_GENE_PRODUCT", start_char = match.start(), end_char = match.end())
+                    for match in self.pattern.finditer(text)]
+            yield SimpleNamespace(ents = ents), context
+
+# Test that chunks cover the paper within the size limit, and that each entity on a chunk border is kept once
+def test_chunk_windows():
+
+    paper_directory = os.path.join(os.getcwd(), "chunk_papers")
+    os.mkdir(paper_directory)
+    sentences = ["Sentence " + str(x) + " shows that adenosine kinase binds" + " glucose" * (x % 4) + "." for x in range(30)]
+    sentences.insert(10, " ".join(["the adenosine kinase of liver"] * 20) + ".")
+    content = " ".join(sentences)
+    paper_path = os.path.join(paper_directory, "12345678.txt")
+    with open(paper_path, "w") as f:
+        f.write(content)
+
+    chunk_size, chunk_overlap = 120, 40
+    spans = sentence_spans(content, "regex")
+    windows = getattr(extract_terms, "__chunk_windows")(content, spans, chunk_size, chunk_overlap)
+
+    # The own text of each chunk starts where the previous one ends, within the size and overlap limits
+    assert windows[0][2] == spans[0][0]
+    assert windows[-1][1] == spans[-1][1]
+    for position, (start, end, core_start) in enumerate(windows):
+        assert start <= core_start < end
+        assert end - core_start <= chunk_size
+        assert core_start - start <= chunk_overlap
+        if position > 0:
+            assert content[windows[position - 1][1]:core_start].strip() == ""
+
+    # Every entity in the paper is kept once, including those cut off at the end of a chunk
+    texts = getattr(extract_terms, "__stream_texts")([paper_path], None, "regex", chunk_size, chunk_overlap, False)
+    ner = PatternNER(r"adenosine kinase|glucose")
+    entities = list(getattr(extract_terms, "__paper_entities")(ner, texts, 32, 1))[0][1]
+    expected = [(match.group(), "GENE_OR_GENE_PRODUCT", match.start(), match.end()) for match in ner.pattern.finditer(content)]
+    assert sorted(entities, key = lambda x: x[2]) == expected
+
+    shutil.rmtree(paper_directory)
+
+# Test term counts, document frequencies, and stop word and length filters with made-up entities in place of the model
+def test_count_terms(monkeypatch):
+
+    paper_directory = os.path.join(os.getcwd(), "count_papers")
+    os.mkdir(paper_directory)
+    entities = {
+        "1.txt": [("ATP", "SIMPLE_CHEMICAL", 0, 3), ("atp.", "SIMPLE_CHEMICAL", 10, 14), ("Insulin", "GENE_OR_GENE_PRODUCT", 20, 27),
+                  ("activator", "SIMPLE_CHEMICAL", 30, 39), ("ab", "SIMPLE_CHEMICAL", 40, 42), ("Liver", "ORGAN", 50, 55)],
+        "2.txt": [("ATP", "SIMPLE_CHEMICAL", 0, 3), ("Glucose", "SIMPLE_CHEMICAL", 10, 17)],
+        "3.txt": [("ATP", "GENE_OR_GENE_PRODUCT", 0, 3), ("Myterm", "SIMPLE_CHEMICAL", 10, 16)]
+    }
+    for file in entities:
+        with open(os.path.join(paper_directory, file), "w") as f:
+            f.write("text")
+    monkeypatch.setattr(extract_terms, "__scispacy_entities",
+                        lambda paper_list, *args: ((file, entities[os.path.basename(file)]) for file in sorted(paper_list)))
+
+    # Terms are lowercased and cleaned, and stop words, short terms, and other tags are removed
+    table = dance.count_terms_scispacy(paper_directory, "omes", additional_stop_words = ["myterm"])
+    assert table.values.tolist() == [
+        ["atp", "SIMPLE_CHEMICAL", 2, 3],
+        ["atp", "GENE_OR_GENE_PRODUCT", 1, 1],
+        ["glucose", "SIMPLE_CHEMICAL", 1, 1],
+        ["insulin", "GENE_OR_GENE_PRODUCT", 1, 1]
+    ]
+
+    # Each paper is counted on its own
+    papers = {os.path.basename(file): counts for file, counts in dance.iter_terms_scispacy(paper_directory, "omes")}
+    assert papers["1.txt"]["count"].sum() == 3 and len(papers["3.txt"]) == 2
+
+    # Terms are kept if they are found with the same label in enough papers
+    assert dance.extract_terms_scispacy(paper_directory, "omes", additional_stop_words = ["myterm"]) == ["atp", "glucose", "insulin"]
+    assert dance.extract_terms_scispacy(paper_directory, "omes", min_document_frequency = 2) == ["atp"]
+
+    shutil.rmtree(paper_directory)
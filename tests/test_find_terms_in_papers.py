@@ -0,0 +1,220 @@
+import os
+import shutil
+import pytest
+import pandas as pd
+import DancePartner as dance
+
+## How to calculate coverage (from within main package directory):
+# coverage run --source=DancePartner -m pytest -x tests/* -W ignore
+# coverage report
+# coverage html
+
+# Test that the term automaton finds overlapping, multi-word terms on word boundaries only
+def test_term_matcher():
+
+    matcher = dance.TermMatcher(["ATP", "atp synthase", "ATP synthase subunit alpha", "synthase", "ase", "atp"])
+    assert len(matcher) == 5
+
+    sentence = "the atp synthase subunit alpha binds atp"
+    found = sorted((start, end, matcher.terms[term]) for start, end, term in matcher.find(sentence))
+
+    assert found == [
+        (4, 7, "atp"),
+        (4, 16, "atp synthase"),
+        (4, 30, "atp synthase subunit alpha"),
+        (8, 16, "synthase"),
+        (37, 40, "atp")
+    ]
+
+# Test that a saved and loaded term index finds the same terms
+def test_term_index():
+
+    output_directory = os.path.join(os.getcwd(), "term_index_test")
+    index = dance.TermIndex(["ATP", "atp synthase", "NADH", "glucose-6-phosphate"])
+    index.save(output_directory)
+    loaded = dance.TermIndex.load(output_directory)
+
+    assert loaded.terms == index.terms
+    assert loaded.term_positions == index.term_positions
+    assert loaded.matcher._vocabulary == index.matcher._vocabulary
+    assert "glucose6phosphate" in loaded
+
+    sentence = "atp synthase uses nadh and atp"
+    assert loaded.matcher.find(sentence) == index.matcher.find(sentence)
+
+    shutil.rmtree(output_directory)
+
+# Test that an incremental rescan after adding a paper and a term matches a full scan
+def test_incremental_find_terms():
+
+    # Copy a few papers to a new directory
+    paper_directory = os.path.join(os.getcwd(), "incremental_papers")
+    output_directory = os.path.join(os.getcwd(), "incremental_test")
+    full_directory = os.path.join(os.getcwd(), "incremental_full")
+    shutil.copytree("example_data/papers/pubmed_clean", paper_directory)
+    os.mkdir(output_directory)
+    os.mkdir(full_directory)
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria"]
+
+    # Scan, then add a paper and a term and scan again
+    dance.find_terms_in_papers(paper_directory, terms, output_directory = output_directory, incremental = True)
+    shutil.copy("example_data/papers/pubmed_pdfs/37432911.txt", paper_directory)
+    terms.append("membrane")
+    dance.find_terms_in_papers(paper_directory, terms, output_directory = output_directory, incremental = True)
+    dance.find_terms_in_papers(paper_directory, terms, output_directory = full_directory)
+
+    # Both tables should hold the same rows
+    columns = ["paper_id", "term_1", "term_2", "sentence_index", "segment"]
+    incremental = pd.read_csv(os.path.join(output_directory, "sentence_biomolecule_pairs.csv")).sort_values(columns).reset_index(drop = True)
+    full = pd.read_csv(os.path.join(full_directory, "sentence_biomolecule_pairs.csv")).sort_values(columns).reset_index(drop = True)
+    assert incremental.equals(full)
+
+    shutil.rmtree(paper_directory)
+    shutil.rmtree(output_directory)
+    shutil.rmtree(full_directory)
+
+# Test that deduplicated sentences fan back out to the same rows as a full scan
+def test_deduplicate_sentences():
+
+    # Copy a paper under a second paper_id
+    paper_directory = os.path.join(os.getcwd(), "dedup_papers")
+    shutil.copytree("example_data/papers/pubmed_clean", paper_directory)
+    shutil.copy(os.path.join(paper_directory, "30788345.txt"), os.path.join(paper_directory, "99999999.txt"))
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria", "membrane", "acid"]
+
+    output_directory = os.path.join(os.getcwd(), "dedup_test")
+    os.mkdir(output_directory)
+    full = dance.find_terms_in_papers(paper_directory, terms)
+    dance.find_terms_in_papers(paper_directory, terms, output_directory = output_directory, deduplicate_sentences = True)
+    pairs = pd.read_csv(os.path.join(output_directory, "sentence_biomolecule_pairs.csv"), dtype = {"paper_id": str})
+    occurrences = pd.read_csv(os.path.join(output_directory, "sentence_occurrences.csv"), dtype = {"paper_id": str})
+    assert len(pairs) < len(full)
+    assert "99999999" not in pairs["paper_id"].values
+
+    # Expanding the duplicates should restore every row
+    columns = ["paper_id", "term_1", "term_2", "sentence_index", "segment"]
+    expanded = dance.expand_sentence_duplicates(pairs, occurrences).drop(columns = "sentence_hash")
+    assert expanded.sort_values(columns).reset_index(drop = True).equals(full.sort_values(columns).reset_index(drop = True))
+
+    # Co-occurrence counts every sentence, so deduplicating does not change them, or the deduplicated rows
+    both_directory = os.path.join(os.getcwd(), "dedup_cooccurrence_test")
+    counts_directory = os.path.join(os.getcwd(), "dedup_counts_test")
+    os.mkdir(both_directory)
+    os.mkdir(counts_directory)
+    dance.find_terms_in_papers(paper_directory, terms, output_directory = both_directory, deduplicate_sentences = True, cooccurrence = True)
+    dance.find_terms_in_papers(paper_directory, terms, output_directory = counts_directory, cooccurrence = True)
+    both = dance.CooccurrenceMatrix.load(both_directory)
+    counts = dance.CooccurrenceMatrix.load(counts_directory)
+    assert both.n_papers == counts.n_papers and both.n_sentences == counts.n_sentences
+    assert (both.paper_counts != counts.paper_counts).nnz == 0
+    assert (both.sentence_counts != counts.sentence_counts).nnz == 0
+    assert pd.read_csv(os.path.join(both_directory, "sentence_biomolecule_pairs.csv"), dtype = {"paper_id": str}).equals(pairs)
+
+    shutil.rmtree(paper_directory)
+    shutil.rmtree(output_directory)
+    shutil.rmtree(both_directory)
+    shutil.rmtree(counts_directory)
+
+# Test that sentence-level co-occurrence counts match the pairs table, and that scores are computed for each pair
+def test_cooccurrence():
+
+    output_directory = os.path.join(os.getcwd(), "cooccurrence_test")
+    saved_directory = os.path.join(os.getcwd(), "cooccurrence_saved")
+    os.mkdir(output_directory)
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria", "membrane", "acid"]
+
+    # With no length limit, every pair of terms in a sentence is a row
+    dance.find_terms_in_papers("example_data/papers/pubmed_clean", terms, output_directory = output_directory, max_char_length = 1000000, cooccurrence = True)
+    pairs = pd.read_csv(os.path.join(output_directory, "sentence_biomolecule_pairs.csv"))
+    matrix = dance.CooccurrenceMatrix.load(output_directory)
+    counts = pd.concat([pairs["term_1"], pairs["term_2"]], axis = 1).apply(sorted, axis = 1).value_counts()
+    for (term1, term2), count in counts.items():
+        assert matrix.sentence_counts[matrix.terms.index(term1), matrix.terms.index(term2)] == count
+    assert (matrix.sentence_counts != matrix.sentence_counts.T).nnz == 0
+    assert matrix.n_papers == 6
+
+    # Saved matrices should load back the same
+    matrix.save(saved_directory)
+    loaded = dance.CooccurrenceMatrix.load(saved_directory)
+    assert loaded.terms == matrix.terms
+    assert (loaded.paper_counts != matrix.paper_counts).nnz == 0
+
+    scores = dance.score_cooccurrence(loaded, level = "paper", method = "npmi")
+    assert len(scores) > 0
+    assert scores["score"].between(-1, 1).all()
+
+    # The extra outputs are only written to a directory, so the returned table is always a DataFrame
+    with pytest.raises(Exception):
+        dance.find_terms_in_papers("example_data/papers/pubmed_clean", terms, cooccurrence = True)
+
+    shutil.rmtree(output_directory)
+    shutil.rmtree(saved_directory)
+
+# Test that term offsets point at each term within its segment
+def test_term_offsets():
+
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria", "membrane", "fatty acid"]
+    pairs = dance.find_terms_in_papers("example_data/papers", terms, max_char_length = 100, padding = 20)
+    assert len(pairs) > 0
+
+    for row in pairs.itertuples():
+        for term, start, end in [(row.term_1, row.term_1_start, row.term_1_end), (row.term_2, row.term_2_start, row.term_2_end)]:
+            if start >= 0:
+                assert row.segment[start:end].split() == term.split()
+
+# Test that scanning papers with a process pool finds the same rows, in the same order, as a serial scan
+def test_find_terms_workers():
+
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria", "membrane", "acid"]
+    serial = dance.find_terms_in_papers("example_data/papers", terms)
+    parallel = dance.find_terms_in_papers("example_data/papers", terms, n_workers = 2)
+    assert len(serial) > 0
+    assert parallel.equals(serial)
+
+# Test that synonyms of one biomolecule are not paired, and that one row is kept per sentence and pair of IDs
+def test_find_terms_synonyms():
+
+    paper_directory = os.path.join(os.getcwd(), "synonym_papers")
+    os.mkdir(paper_directory)
+    with open(os.path.join(paper_directory, "12345678.txt"), "w") as f:
+        f.write("Levels of ATP fell as glucose rose, and adenosine triphosphate was restored by glucose and insulin.")
+    terms = ["atp", "adenosine triphosphate", "glucose", "insulin"]
+    synonyms = pd.DataFrame({
+        "Synonym": ["atp", "adenosinetriphosphate", "glucose"],
+        "ID": ["CHEBI:15422", "CHEBI:15422", "CHEBI:17234"],
+        "Type": ["metabolite", "metabolite", "metabolite"]
+    })
+
+    pairs = dance.find_terms_in_papers(paper_directory, terms)
+    collapsed = dance.find_terms_in_papers(paper_directory, terms, synonyms = synonyms)
+    assert len(pairs) == 6
+
+    # The ATP synonyms are never paired, the first mention of each ID is kept, and insulin has no ID
+    found = sorted(zip(collapsed["term_1"], collapsed["term_2"]))
+    assert found == [("atp", "glucose"), ("atp", "insulin"), ("glucose", "insulin")]
+
+    shutil.rmtree(paper_directory)
+
+# Test that streaming the rows, or writing them in small chunks, gives the same table as a single scan
+def test_find_terms_streaming():
+
+    output_directory = os.path.join(os.getcwd(), "streaming_test")
+    chunked_directory = os.path.join(os.getcwd(), "streaming_chunked")
+    os.mkdir(output_directory)
+    os.mkdir(chunked_directory)
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria", "membrane", "acid"]
+
+    pairs = dance.find_terms_in_papers("example_data/papers", terms)
+    streamed = pd.DataFrame(list(dance.iter_terms_in_papers("example_data/papers", terms)), columns = pairs.columns)
+    assert streamed.equals(pairs)
+
+    dance.find_terms_in_papers("example_data/papers", terms, output_directory = output_directory)
+    dance.find_terms_in_papers("example_data/papers", terms, output_directory = chunked_directory, chunk_size = 3)
+    with open(os.path.join(output_directory, "sentence_biomolecule_pairs.csv"), "rb") as f:
+        whole = f.read()
+    with open(os.path.join(chunked_directory, "sentence_biomolecule_pairs.csv"), "rb") as f:
+        chunked = f.read()
+    assert len(whole) > 0 and chunked == whole
+
+    shutil.rmtree(output_directory)
+    shutil.rmtree(chunked_directory)
@@ -1,6 +1,9 @@
 import shutil
 import os
+import pytest
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import DancePartner as dance
 
 ## How to calculate coverage (from within main package directory): 
@@ -44,4 +47,299 @@ def test_run_bert():
     network = dance.visualize_network(network_table)
     metrics = dance.calculate_network_metrics(network)
 
-    shutil.rmtree(output_directory)
\ No newline at end of file
+    shutil.rmtree(output_directory)
+
+# Test that batches stay under the token budget and cover every sequence once
+def test_token_budget_batch_sampler():
+
+    lengths = [12, 80, 45, 12, 300, 33, 80, 7, 64, 19]
+    sampler = dance.TokenBudgetBatchSampler(lengths, max_tokens = 200)
+
+    assert sorted(sampler.order().tolist()) == list(range(len(lengths)))
+    for batch in sampler:
+        assert len(batch) * max(lengths[x] for x in batch) <= 200 or len(batch) == 1
+
+# Find pairs in the example papers and score them once with the torch engine, for the tests of the other engines and options
+@pytest.fixture(scope = "module")
+def torch_results():
+
+    output_directory = os.path.join(os.getcwd(), "testbertpairs")
+    os.mkdir(output_directory)
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria", "membrane", "acid"]
+    dance.find_terms_in_papers("example_data/papers", terms, output_directory = output_directory)
+    input_path = os.path.join(output_directory, "sentence_biomolecule_pairs.csv")
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch")
+
+    yield input_path, pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+
+    shutil.rmtree(output_directory)
+
+# Test that the torch engine scores the same rows as the trainer engine
+def test_run_bert_torch_engine(torch_results):
+
+    input_path, torch = torch_results
+    output_directory = os.path.join(os.getcwd(), "testengine")
+    os.mkdir(output_directory)
+
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment")
+    trainer = pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+
+    assert trainer["Sentence"].equals(torch["Sentence"])
+    assert (trainer["True Positive"] - torch["True Positive"]).abs().max() < 1e-4
+
+    shutil.rmtree(output_directory)
+
+# Test that a chunked run resumes from its checkpoint and matches an unchunked run
+def test_run_bert_chunked(torch_results, monkeypatch):
+
+    input_path, whole = torch_results
+    output_directory = os.path.join(os.getcwd(), "testchunks")
+    os.mkdir(output_directory)
+    output_path = os.path.join(output_directory, "bert_results.txt")
+
+    # Count the rows scored by each call, and interrupt the first chunked run after two chunks
+    predict = dance.BertPredictor.predict
+    scored_rows = []
+    def counting_predict(self, table, *args):
+        if interrupt and len(scored_rows) == 2:
+            raise Exception("interrupted")
+        scored_rows.append(len(table))
+        return predict(self, table, *args)
+    monkeypatch.setattr(dance.BertPredictor, "predict", counting_predict)
+
+    interrupt = True
+    with pytest.raises(Exception, match = "interrupted"):
+        dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch", chunk_size = 10)
+
+    # A partial line after the checkpoint, as left by an interrupted run, is dropped on restart
+    with open(output_path, "a") as f:
+        f.write("partial")
+
+    # The restarted run only scores the chunks that were not finished
+    interrupt = False
+    scored_rows.clear()
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch", chunk_size = 10)
+    chunked = pd.read_table(output_path)
+    remaining_rows = len(pd.read_csv(input_path)) - 20
+    assert remaining_rows > 0
+    assert sum(scored_rows) == remaining_rows
+    assert len(scored_rows) == (remaining_rows + 9) // 10
+
+    assert whole["Sentence"].equals(chunked["Sentence"])
+    assert (whole["True Positive"] - chunked["True Positive"]).abs().max() < 1e-4
+
+    # A run with a setting that changes the results does not reuse the checkpoint
+    scored_rows.clear()
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch", chunk_size = 10, quantize = True)
+    assert sum(scored_rows) == remaining_rows + 20
+    assert len(pd.read_table(output_path)) == len(whole)
+
+    shutil.rmtree(output_directory)
+
+# Test that the exported ONNX model scores the same as the PyTorch model
+def test_run_bert_onnx_parity(torch_results):
+
+    pytest.importorskip("onnxruntime")
+
+    input_path, torch = torch_results
+    output_directory = os.path.join(os.getcwd(), "testonnx")
+    os.mkdir(output_directory)
+    onnx_path = dance.export_bert_onnx("biobert", os.path.join(output_directory, "bert_src.onnx"))
+
+    dance.run_bert(input_path, model_path = onnx_path, output_directory = output_directory, segment_col_name = "segment", engine = "onnx")
+    onnx = pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+
+    assert torch["Sentence"].equals(onnx["Sentence"])
+    assert (torch["True Positive"] - onnx["True Positive"]).abs().max() < 1e-4
+
+    # The predictor has the attributes of a BertPredictor, without a torch model
+    predictor = dance.OnnxBertPredictor(onnx_path)
+    assert predictor.device.type == "cpu" and predictor.model is None
+    assert np.abs(predictor.predict(pd.read_csv(input_path))["True Positive"].values - onnx["True Positive"].values).max() < 1e-6
+
+    shutil.rmtree(output_directory)
+
+# Test that the int8 quantized model mostly agrees with the full model and is smaller
+def test_quantization_agreement(torch_results):
+
+    input_path, _ = torch_results
+    output_directory = os.path.join(os.getcwd(), "testquantize")
+    os.mkdir(output_directory)
+
+    report = dance.quantization_agreement(pd.read_csv(input_path), model_path = "biobert")
+    assert report["pairs"] > 0
+    assert report["agreement"] >= 0.9
+    assert report["int8_megabytes"] < report["fp32_megabytes"]
+
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch", quantize = True)
+    assert len(pd.read_table(os.path.join(output_directory, "bert_results.txt"))) == report["pairs"]
+
+    shutil.rmtree(output_directory)
+
+# Test that the prediction cache returns what was stored and evicts the least recently used predictions
+def test_prediction_cache():
+
+    cache_path = os.path.join(os.getcwd(), "testcache.sqlite")
+    cache = dance.PredictionCache(cache_path, max_entries = 5)
+    keys = cache.keys(["input " + str(x) for x in range(8)], "model")
+    assert cache.keys(["input 0"], "another model") != keys[:1]
+
+    cache.put(keys[:4], [[0.25, 0.75]] * 4)
+    assert (cache.get(keys[:1]) == [[0.25, 0.75]]).all()
+    cache.put(keys[4:], [[1, 0]] * 4)
+
+    assert len(cache) == 5
+    missing = pd.isna(cache.get(keys)).any(axis = 1).tolist()
+    assert missing == [False, True, True, True, False, False, False, False]
+
+    # Replacing stored predictions does not evict others
+    cache.put(keys[4:6], [[0, 1]] * 2)
+    assert len(cache) == 5
+    assert pd.isna(cache.get(keys[:1] + keys[4:])).any() == False
+
+    cache.close()
+    with dance.PredictionCache(cache_path, max_entries = 5) as reopened:
+        assert (reopened.get(keys[4:5]) == [[0, 1]]).all()
+    for file in [cache_path, cache_path + "-wal", cache_path + "-shm"]:
+        if os.path.exists(file):
+            os.remove(file)
+
+# Test that a rerun with a cache reads every prediction from the cache
+def test_run_bert_cache(torch_results):
+
+    input_path, uncached = torch_results
+    output_directory = os.path.join(os.getcwd(), "testbertcache")
+    os.mkdir(output_directory)
+    cache_path = os.path.join(output_directory, "predictions.sqlite")
+
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch", cache_path = cache_path)
+    assert len(dance.PredictionCache(cache_path)) == uncached["Sentence"].nunique()
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch", cache_path = cache_path)
+    cached = pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+
+    assert uncached["Sentence"].equals(cached["Sentence"])
+    assert (uncached["True Positive"] - cached["True Positive"]).abs().max() < 1e-4
+
+    shutil.rmtree(output_directory)
+
+# Test that the server scores tables sent at the same time in one batch, with the same results as the predictor
+def test_bert_server(torch_results):
+
+    input_path, direct = torch_results
+    output_directory = os.path.join(os.getcwd(), "testserver")
+    os.mkdir(output_directory)
+    pairs = pd.read_csv(input_path)
+
+    predictor = dance.BertPredictor("biobert", device = "cpu")
+    server = dance.BertServer(predictor, port = 0, max_wait = 0.5).start()
+
+    dance.run_bert_client(input_path, output_directory, "segment", url = server.url)
+    served = pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+    assert served["Sentence"].tolist() == direct["Sentence"].tolist()
+    assert np.abs(served["True Positive"].values - direct["True Positive"].values).max() < 1e-4
+
+    # Split the table across concurrent clients
+    client = dance.BertClient(server.url)
+    parts = [pairs.iloc[x::4] for x in range(4)]
+    with ThreadPoolExecutor(4) as executor:
+        results = pd.concat(list(executor.map(client.predict, parts))).sort_index()
+    assert results["Sentence"].tolist() == direct["Sentence"].tolist()
+    assert np.abs(results["True Positive"].values - direct["True Positive"].values).max() < 1e-4
+
+    server.shutdown()
+    shutil.rmtree(output_directory)
+
+# Test that scoring with several worker processes keeps the order of the rows
+def test_run_bert_sharded(torch_results, monkeypatch):
+
+    input_path, single = torch_results
+    output_directory = os.path.join(os.getcwd(), "testsharded")
+    os.mkdir(output_directory)
+
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch",
+                   n_processes = 2, num_threads = 1, max_tokens = 512)
+    sharded = pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+
+    assert single["Sentence"].equals(sharded["Sentence"])
+    assert (single["True Positive"] - sharded["True Positive"]).abs().max() < 1e-4
+
+    # A model that cannot be found is reported before any worker is started
+    with pytest.raises(Exception):
+        dance.ShardedBertPredictor(output_directory, n_processes = 2)
+    with pytest.raises(Exception):
+        dance.ShardedBertPredictor(output_directory, n_processes = 2, engine = "onnx")
+
+    # The workers and the cache are closed when the setup fails after they have started, such as with a missing prefilter
+    closed = []
+    for cls in [dance.ShardedBertPredictor, dance.PredictionCache]:
+        monkeypatch.setattr(cls, "close", lambda self, close = cls.close: closed.append(type(self).__name__) or close(self))
+    with pytest.raises(Exception):
+        dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch",
+                       n_processes = 2, num_threads = 1, cache_path = os.path.join(output_directory, "cache.sqlite"),
+                       prefilter = os.path.join(output_directory, "missing"))
+    assert sorted(closed) == ["PredictionCache", "ShardedBertPredictor"]
+
+    shutil.rmtree(output_directory)
+
+# Test that the multi-pair engine refuses a pairwise model, and accepts one fine-tuned with fine_tune_multi_pair
+def test_run_bert_multi_pair(torch_results):
+
+    input_path, pairwise = torch_results
+    output_directory = os.path.join(os.getcwd(), "testmultipair")
+    os.mkdir(output_directory)
+
+    with pytest.raises(Exception):
+        dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "multi_pair")
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "multi_pair",
+                   approximate = True)
+    assert pairwise["Sentence"].equals(pd.read_table(os.path.join(output_directory, "bert_results.txt"))["Sentence"])
+
+    # Fine-tune briefly on the calls of the pairwise model. This checks that training runs and that its model is
+    # accepted, not how well it learns.
+    keys = ["paper_id", "sentence_index", "term_1", "term_2"]
+    pairs = pd.read_csv(input_path).merge(pairwise[keys + ["True Positive"]], on = keys)
+    assert len(pairs) == len(pairwise)
+    pairs["label"] = pairs["True Positive"] >= 0.5
+    tuned_path = os.path.join(output_directory, "multi_pair_model")
+    losses = dance.fine_tune_multi_pair(pairs, "biobert", tuned_path, "label", epochs = 2, max_tokens = 256)
+    assert len(losses) == 2 and np.isfinite(losses).all()
+
+    dance.run_bert(input_path, model_path = tuned_path, output_directory = output_directory, segment_col_name = "segment", engine = "multi_pair")
+    multi_pair = pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+    assert pairwise["Sentence"].equals(multi_pair["Sentence"])
+    assert np.abs(multi_pair["True Negative"] + multi_pair["True Positive"] - 1).max() < 1e-5
+
+    shutil.rmtree(output_directory)
+
+# Test that the prefilter keeps its target recall, and that run_bert only scores the pairs it keeps
+def test_prefilter(torch_results):
+
+    input_path, results = torch_results
+    output_directory = os.path.join(os.getcwd(), "testprefilter")
+    os.mkdir(output_directory)
+
+    labels = results["True Positive"] >= results["True Positive"].median()
+    prefilter = dance.PairPrefilter(n_features = 2 ** 12).fit(results, target_recall = 0.9, label_threshold = results["True Positive"].median(), validation_fraction = 0)
+
+    curve = dance.prefilter_recall(prefilter, results, label_threshold = results["True Positive"].median())
+    assert curve["recall"].is_monotonic_decreasing and curve["fraction_skipped"].is_monotonic_increasing
+    assert curve.loc[curve["threshold"] == prefilter.threshold, "recall"].iloc[0] >= 0.9
+
+    # Rows BERT cannot score have no prefilter score, and are not counted
+    unscorable = pd.concat([results, results.head(3).assign(Sentence = None)], ignore_index = True)
+    assert dance.prefilter_recall(prefilter, unscorable, label_threshold = results["True Positive"].median()).notna().all().all()
+
+    prefilter.save(output_directory)
+    loaded = dance.PairPrefilter.load(output_directory)
+    assert pd.Series(loaded.score(pd.read_csv(input_path))).equals(pd.Series(prefilter.score(pd.read_csv(input_path))))
+    assert loaded.threshold == prefilter.threshold
+    kept = prefilter.score(results) >= prefilter.threshold
+    assert labels[kept].sum() >= 0.9 * labels.sum()
+
+    dance.run_bert(input_path, model_path = "biobert", output_directory = output_directory, segment_col_name = "segment", engine = "torch",
+                   prefilter = output_directory)
+    filtered = pd.read_table(os.path.join(output_directory, "bert_results.txt"))
+    assert filtered["Sentence"].tolist() == results["Sentence"][kept].tolist()
+    assert np.abs(filtered["True Positive"].values - results["True Positive"][kept].values).max() < 1e-4
+
+    shutil.rmtree(output_directory)
@@ -0,0 +1,80 @@
+import os
+import shutil
+import DancePartner as dance
+from DancePartner import sentence_cache
+from DancePartner.sentence_cache import sentence_spans
+
+## How to calculate coverage (from within main package directory):
+# coverage run --source=DancePartner -m pytest -x tests/* -W ignore
+# coverage report
+# coverage html
+
+# Test that the regex splitter does not split on abbreviations, initials, or genus names
+def test_regex_sentence_spans():
+
+    text = "We used C. elegans (Fig. 2) as described by Zhu et al. in 2019. The ATP levels rose! “Levels fell,” they said."
+    sentences = [text[start:end] for start, end in sentence_spans(text, "regex")]
+    assert sentences == [
+        "We used C. elegans (Fig. 2) as described by Zhu et al. in 2019.",
+        "The ATP levels rose!",
+        "“Levels fell,” they said."
+    ]
+
+# Measure how far the regex sentence boundaries drift from NLTK's on the example papers
+def test_regex_sentence_drift():
+
+    nltk_ends, regex_ends, shared_ends = 0, 0, 0
+    for root, _, files in os.walk("example_data/papers"):
+        for file in files:
+            if file.endswith(".txt") is False or file == "output_summary.txt":
+                continue
+            with open(os.path.join(root, file), "r") as f:
+                text = f.read()
+            nltk_boundaries = set(end for _, end in sentence_spans(text, "nltk"))
+            regex_boundaries = set(end for _, end in sentence_spans(text, "regex"))
+            nltk_ends += len(nltk_boundaries)
+            regex_ends += len(regex_boundaries)
+            shared_ends += len(nltk_boundaries.intersection(regex_boundaries))
+
+    # Share of NLTK sentence ends found by the regex splitter, and share of regex sentence ends that NLTK agrees with
+    recall = shared_ends / nltk_ends
+    precision = shared_ends / regex_ends
+    assert recall >= 0.85
+    assert precision >= 0.85
+
+# Test that cached sentences give the same pairs, and that entries are reused until the paper or tokenizer changes
+def test_sentence_cache(monkeypatch):
+
+    paper_directory = os.path.join(os.getcwd(), "cache_papers")
+    cache_directory = os.path.join(os.getcwd(), "sentence_cache_test")
+    shutil.copytree("example_data/papers/pubmed_clean", paper_directory)
+    terms = ["atp", "glucose", "nadh", "protein", "lipid", "cell", "insulin", "mitochondria", "membrane", "acid"]
+    n_papers = dance.cache_sentences(paper_directory, cache_directory)
+    assert n_papers > 1 and len(os.listdir(cache_directory)) == n_papers
+
+    # Count the papers that are split into sentences
+    segment_paper = getattr(sentence_cache, "__segment_paper")
+    segmented = []
+    def counting_segment_paper(content, tokenizer):
+        segmented.append(tokenizer)
+        return segment_paper(content, tokenizer)
+    monkeypatch.setattr(sentence_cache, "__segment_paper", counting_segment_paper)
+
+    uncached = dance.find_terms_in_papers(paper_directory, terms)
+    segmented.clear()
+    cached = dance.find_terms_in_papers(paper_directory, terms, cache_directory = cache_directory)
+    assert cached.equals(uncached)
+    assert segmented == []
+
+    # A changed paper is split again, and so is every paper with another tokenizer
+    with open(os.path.join(paper_directory, sorted(os.listdir(paper_directory))[0]), "a") as f:
+        f.write(" Insulin lowered glucose.")
+    dance.find_terms_in_papers(paper_directory, terms, cache_directory = cache_directory)
+    assert segmented == ["nltk"]
+    segmented.clear()
+    dance.find_terms_in_papers(paper_directory, terms, cache_directory = cache_directory, tokenizer = "regex")
+    assert segmented == ["regex"] * n_papers
+    assert len(os.listdir(cache_directory)) == 2 * n_papers + 1
+
+    shutil.rmtree(paper_directory)
+    shutil.rmtree(cache_directory)